@@ -2,20 +2,41 @@
 
 from datetime import datetime, timedelta
 from dateutil import parser
+import heapq
 import itertools
 import json
 import logging
+import math
 import os
+import random
 import re
 import sys
 import requests
+import socket
+import signal
+import sqlite3
 import time
 import argparse
+import asyncio
+import concurrent.futures
+import csv
 import uuid
 import defusedxml.ElementTree as ET
 import urllib.robotparser
-from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
+from urllib.parse import urlparse, parse_qs, urlencode, urlunparse, quote, unquote
 import xxhash
+import threading
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
+from urllib3.util.connection import allowed_gai_family
+
+# Optional: --http2-hosts needs `pip install httpx[http2]`, which isn't in requirements.txt
+try:
+    import httpx
+    # httpx only speaks HTTP/2 with the h2 package installed, as httpx[http2] does
+    import h2
+except ImportError:
+    httpx = None
 
 logger = logging.getLogger("FediFetcher")
 robotParser = urllib.robotparser.RobotFileParser()
@@ -37,13 +58,19 @@ argparser.add_argument('--max-bookmarks', required = False, type=int, default=0,
 argparser.add_argument('--max-favourites', required = False, type=int, default=0, help="Fetch remote replies to the API key owners Favourites. We'll fetch replies to at most this many favourites")
 argparser.add_argument('--from-notifications', required = False, type=int, default=0, help="Backfill accounts of anyone appearing in your notifications, during the last hours")
 argparser.add_argument('--remember-users-for-hours', required=False, type=int, default=24*7, help="How long to remember users that you aren't following for, before trying to backfill them again.")
-argparser.add_argument('--remember-hosts-for-days', required=False, type=int, default=30, help="How long to remember host info for, before checking again.")
-argparser.add_argument('--http-timeout', required = False, type=int, default=5, help="The timeout for any HTTP requests to your own, or other instances.")
+argparser.add_argument('--remember-hosts-for-days', required=False, type=int, default=30, help="How long to remember host info for, before checking again. With --http-cache-days, host info is also revalidated with conditional requests once its nodeinfo's Cache-Control max-age has passed, but not more than once an hour.")
+argparser.add_argument('--http-timeout', required = False, type=int, default=5, help="The timeout for any HTTP requests to your own, or other instances. Once we have seen enough responses from a server, we'll use a timeout based on how quickly it usually responds instead.")
+argparser.add_argument('--http-connect-timeout', required = False, type=int, default=3, help="The timeout for establishing a connection to your own, or other instances.")
+argparser.add_argument('--http-max-timeout', required = False, type=int, default=30, help="The longest timeout we'll allow for a slow server, based on how quickly it usually responds.")
 argparser.add_argument('--backfill-with-context', required = False, type=int, default=1, help="If enabled, we'll fetch remote replies when backfilling profiles. Set to `0` to disable.")
 argparser.add_argument('--backfill-mentioned-users', required = False, type=int, default=1, help="If enabled, we'll backfill any mentioned users when fetching remote replies to timeline posts. Set to `0` to disable.")
+argparser.add_argument('--max-runtime', required = False, type=int, default=0, help="Wind down gracefully, so that a run finishes within this many minutes: towards the end of the run we'll stop starting new backfills, then new context fetches, and finally new context resolves. Set to `0` for no limit.")
 argparser.add_argument('--lock-hours', required = False, type=int, default=24, help="The lock timeout in hours.")
 argparser.add_argument('--lock-file', required = False, default=None, help="Location of the lock file")
 argparser.add_argument('--state-dir', required = False, default="artifacts", help="Directory to store persistent files and possibly lock file")
+argparser.add_argument('--checkpoint-interval', required=False, type=int, default=10, help="Save the state, and the work still left to do, every this many minutes during a run, so that the next run can carry on where an interrupted run stopped. The state is also saved when FediFetcher receives SIGTERM. Set to `0` to only save at the end of the run, or when terminated.")
+argparser.add_argument('--seen-urls-history', required=False, type=int, default=0, help="Remember at least this many added toots, instead of only the last 100000, so that they aren't added to your server again. This uses a Bloom filter in --state-dir of less than 4 bytes per toot. About 1 in 1000 new toots will be mistaken for ones we added before. Set to `0` to disable.")
+argparser.add_argument('--state-db', required=False, type=int, default=0, help="Set to `1` to keep seen URLs, users, hosts, toots and robots.txt files in a SQLite database in --state-dir, instead of in separate files that are read and written in full on every run. Existing state files are imported into the database on its first use.")
 argparser.add_argument('--on-done', required = False, default=None, help="Provide a url that will be pinged when processing has completed. You can use this for 'dead man switch' monitoring of your task")
 argparser.add_argument('--on-start', required = False, default=None, help="Provide a url that will be pinged when processing is starting. You can use this for 'dead man switch' monitoring of your task")
 argparser.add_argument('--on-fail', required = False, default=None, help="Provide a url that will be pinged when processing has failed. You can use this for 'dead man switch' monitoring of your task")
@@ -52,7 +79,24 @@ argparser.add_argument('--max-list-length', required=False, type=int, default=10
 argparser.add_argument('--max-list-accounts', required=False, type=int, default=10, help="Determines how many accounts we'll backfill for in each list. This will be ignored, unless you also provide `from-lists = 1`. Set to `0` if you only want to fetch replies in lists.")
 argparser.add_argument('--log-level', required=False, default="DEBUG", help="Severity of events to log (DEBUG|INFO|WARNING|ERROR|CRITICAL)")
 argparser.add_argument('--log-format', required=False, type=str, default="%(asctime)s: %(message)s",help="Specify the log format")
-argparser.add_argument('--instance-blocklist', required=False, type=str, default="",help="A comma-separated array of instances that FediFetcher should never try to connect to")
+argparser.add_argument('--instance-blocklist', required=False, type=str, default="",help="A comma-separated array of instances that FediFetcher should never try to connect to. Use `*.example.com` to block all subdomains of example.com.")
+argparser.add_argument('--domain-blocks-file', required=False, type=str, default="", help="Path to a domain blocks CSV file, as exported by Mastodon. FediFetcher won't connect to any suspended domain in it, or to their subdomains. A file with one domain per line works too.")
+argparser.add_argument('--domain-blocks-from-server', required=False, type=int, default=0, help="Don't connect to any domain your server has suspended, or to their subdomains. The domain blocks are fetched from your server every this many hours, which requires the `admin:read:domain_blocks` scope. Set to `0` to disable.")
+argparser.add_argument('--max-requests-per-host', required=False, type=int, default=0, help="The maximum number of requests to send to any one server (other than your own) in a single run. Context fetches and backfills are interleaved across servers, so that one busy server doesn't use up the run at the expense of all others. Set to `0` for no limit.")
+argparser.add_argument('--resolve-concurrency', required=False, type=int, default=1, help="How many posts to ask your own server to fetch at the same time. Each of these makes your server fetch the post from its origin, so this is limited separately from --concurrency.")
+argparser.add_argument('--resolve-latency-target', required=False, type=int, default=0, help="A p95 latency target in milliseconds for asking your own server to fetch posts. When set, FediFetcher starts with one request at a time, and adds one more while your server stays within the target, up to --resolve-concurrency. It halves the number of concurrent requests whenever your server gets slower than that, or responds with a 429 or 5xx error. Set to `0` to always use --resolve-concurrency.")
+argparser.add_argument('--pool-access-tokens', required=False, type=int, default=0, help="Set to `1` to share all configured access tokens when adding context toots to your server, always using the token that has the most rate limit budget left. This increases how many toots can be added per run when using multiple access tokens. All tokens need the `read:search` scope.")
+argparser.add_argument('--rate-limit-pacing', required=False, type=int, default=50, help="Once a server reports that less than this percentage of its rate limit remains, we'll spread the remaining requests evenly until the limit resets, instead of running into the limit. Set to `0` to only slow down once the limit is exhausted.")
+argparser.add_argument('--max-retries', required=False, type=int, default=2, help="How often to retry a request that timed out, failed to connect, or returned a 502, 503 or 504 status code.")
+argparser.add_argument('--retry-budget', required=False, type=int, default=100, help="The maximum number of retries across the whole run, so that a widespread outage doesn't multiply the run time.")
+argparser.add_argument('--circuit-breaker-threshold', required=False, type=int, default=5, help="Stop sending requests to a server for the rest of the run after this many consecutive timeouts, connection errors or 5xx responses. The server will be tried again once during the next run. Your own server is never skipped. Set to `0` to disable.")
+argparser.add_argument('--http-cache-days', required=False, type=int, default=0, help="Cache nodeinfo, host-meta, robots.txt and Mastodon context responses in --state-dir for this many days, and revalidate them with conditional requests instead of downloading them again. Responses are served from the cache without a request while their Cache-Control max-age allows. Set to `0` to disable the cache.")
+argparser.add_argument('--dns-cache-ttl', required=False, type=int, default=300, help="Cache DNS lookups in memory for this many seconds, and resolve all servers we already know about in the background when starting up. Set to `0` to disable.")
+argparser.add_argument('--http-pool-hosts', required=False, type=int, default=100, help="How many hosts to keep open keep-alive connections to at any one time. Connections to the least recently used host are closed once this is exceeded.")
+argparser.add_argument('--concurrency', required=False, type=int, default=1, help="How many independent requests (context fetches, backfills, context resolves) to run at the same time. Defaults to `1`, which processes everything one after the other.")
+argparser.add_argument('--http2-hosts', required=False, type=str, default="", help="A comma-separated list of servers to talk to over HTTP/2, which multiplexes concurrent requests over a single connection. Use `*` for all servers. Servers that don't support HTTP/2 fall back to HTTP/1.1. Requires the optional `httpx[http2]` package.")
+argparser.add_argument('--benchmark-http2', required=False, type=int, default=0, help="Instead of a normal run, request your home timeline this many times over HTTP/1.1 and then over HTTP/2 (using --concurrency), and log how both transports performed.")
+argparser.add_argument('--http-pool-size', required=False, type=int, default=10, help="The maximum number of keep-alive connections to keep open to any single host.")
 
 def get_notification_users(server, access_token, known_users, max_age):
     since = datetime.now(datetime.now().astimezone().tzinfo) - timedelta(hours=max_age)
@@ -81,29 +125,58 @@ def get_favourites(server, access_token, max):
         "Authorization": f"Bearer {access_token}",
     })
 
-def add_user_posts(server, access_token, followings, known_followings, all_known_users, seen_urls, seen_hosts):
+def add_user_posts(server, access_token, followings, known_followings, all_known_users, seen_urls, seen_hosts, followed = False):
+    users = {}
     for user in followings:
         if user['acct'] not in all_known_users and not user['url'].startswith(f"https://{server}/"):
-            posts = get_user_posts(user, known_followings, server, seen_hosts)
-
-            if(posts != None):
-                count = 0
-                failed = 0
-                for post in posts:
-                    if post.get('reblog') is None and post.get('renoteId') is None and post.get('url') is not None and post.get('url') not in seen_urls:
-                        added = add_post_with_context(post, server, access_token, seen_urls, seen_hosts)
-                        if added is True:
-                            seen_urls.add(post['url'])
-                            count += 1
-                        else:
-                            failed += 1
-                logger.info(f"Added {count} posts for user {user['acct']} with {failed} errors")
-                if failed == 0:
-                    known_followings.add(user['acct'])
-                    all_known_users.add(user['acct'])
+            users.setdefault(user['acct'], user)
+
+    def add_posts(user):
+        if not RUN_BUDGET.allows('backfill') or not HOST_REQUESTS.allows(urlparse(user['url']).netloc):
+            return
+
+        posts = get_user_posts(user, known_followings, server, seen_hosts)
+
+        if(posts != None):
+            count = 0
+            failed = 0
+            skipped = 0
+            for post in posts:
+                if post.get('reblog') is None and post.get('renoteId') is None and post.get('url') is not None and post.get('url') not in seen_urls:
+                    added = add_post_with_context(post, server, access_token, seen_urls, seen_hosts)
+                    if added is True:
+                        seen_urls.add(post['url'])
+                        count += 1
+                    elif added is None:
+                        skipped += 1
+                    else:
+                        failed += 1
+            logger.info(f"Added {count} posts for user {user['acct']} with {failed} errors")
+            if skipped > 0:
+                # the rest of this user's posts are left for the next run
+                logger.info(f"Skipped {skipped} posts for user {user['acct']} to stay within --max-runtime")
+                return
+            if failed == 0:
+                known_followings.add(user['acct'])
+                all_known_users.add(user['acct'])
+        PENDING_WORK.backfilled(access_token, user['acct'])
+
+    PENDING_WORK.add_users(access_token, users.values(), followed)
+    bootstrap_hosts(server, [parsed_url[0] for user in users.values() if not user_has_opted_out(user) and (parsed_url := parse_user_url(user['url'])) is not None], seen_hosts)
+    run_concurrently(add_posts, users.values(), host_of=lambda user: urlparse(user['url']).netloc)
 
 def add_post_with_context(post, server, access_token, seen_urls, seen_hosts):
-    added = add_context_url(post['url'], server, access_token)
+    """Add a backfilled post, and its context if --backfill-with-context is set. Returns None if the post was skipped
+    to stay within --max-runtime"""
+    def resolve(url):
+        if not RUN_BUDGET.allows('resolve'):
+            return None
+        return add_context_url(url, server, access_token)
+
+    # resolved on the same pool, and within the same budget, as context toots
+    added = RESOLVE_POOL.map(resolve, [post['url']])[0]
+    if added is None:
+        return None
     if added is True:
         seen_urls.add(post['url'])
         if ('replies_count' in post or 'in_reply_to_id' in post) and getattr(arguments, 'backfill_with_context', 0) > 0:
@@ -166,6 +239,8 @@ def get_user_posts(user, known_followings, server, seen_hosts):
 def get_user_posts_mastodon(userName, webserver):
     try:
         user_id = get_user_id(webserver, userName)
+    except RateLimitDeferred:
+        raise
     except Exception as ex:
         logger.error(f"Error getting user ID for user {userName}: {ex}")
         return None
@@ -184,6 +259,8 @@ def get_user_posts_mastodon(userName, webserver):
             raise Exception(
                 f"Error getting URL {url}. Status code: {response.status_code}"
             )
+    except RateLimitDeferred:
+        raise
     except Exception as ex:
         logger.error(f"Error getting posts for user {userName}: {ex}")
         return None
@@ -201,6 +278,8 @@ def get_user_posts_lemmy(userName, userUrl, webserver):
                     post['url'] = post['ap_id']
                 return posts
 
+        except RateLimitDeferred:
+            raise
         except Exception as ex:
             logger.error(f"Error getting community posts for community {userName}: {ex}")
         return None
@@ -219,6 +298,8 @@ def get_user_posts_lemmy(userName, userUrl, webserver):
                     post['url'] = post['ap_id']
                 return all_posts
 
+        except RateLimitDeferred:
+            raise
         except Exception as ex:
             logger.error(f"Error getting user posts for user {userName}: {ex}")
         return None
@@ -232,6 +313,8 @@ def get_user_posts_peertube(userName, webserver):
         else:
             logger.error(f"Error getting posts by user {userName} from {webserver}. Status Code: {response.status_code}")
             return None
+    except RateLimitDeferred:
+        raise
     except Exception as ex:
         logger.error(f"Error getting posts by user {userName} from {webserver}. Exception: {ex}")
         return None
@@ -254,6 +337,8 @@ def get_user_posts_misskey(userName, webserver):
         else:
             logger.error(f"Error finding user {userName} from {webserver}. Status Code: {resp.status_code}")
             return None
+    except RateLimitDeferred:
+        raise
     except Exception as ex:
         logger.error(f"Error finding user {userName} from {webserver}. Exception: {ex}")
         return None
@@ -276,6 +361,8 @@ def get_user_posts_misskey(userName, webserver):
         else:
             logger.error(f"Error getting posts by user {userName} from {webserver}. Status Code: {resp.status_code}")
             return None
+    except RateLimitDeferred:
+        raise
     except Exception as ex:
         logger.error(f"Error getting posts by user {userName} from {webserver}. Exception: {ex}")
         return None
@@ -434,10 +521,12 @@ def get_all_reply_toots(
     replies_since = datetime.now() - timedelta(hours=reply_interval_hours)
     reply_toots = list(
         itertools.chain.from_iterable(
-            get_reply_toots(
-                user_id, server, access_token, seen_urls, replies_since
+            run_concurrently(
+                lambda user_id: get_reply_toots(
+                    user_id, server, access_token, seen_urls, replies_since
+                ),
+                user_ids
             )
-            for user_id in user_ids
         )
     )
     logger.info(f"Found {len(reply_toots)} reply toots")
@@ -452,6 +541,8 @@ def get_reply_toots(user_id, server, access_token, seen_urls, reply_since):
         resp = get(url, headers={
             "Authorization": f"Bearer {access_token}",
         })
+    except RateLimitDeferred:
+        raise
     except Exception as ex:
         logger.error(
             f"Error getting replies for user {user_id} on server {server}: {ex}"
@@ -490,6 +581,9 @@ def toot_context_should_be_fetched(toot):
     if toot['uri'] not in recently_checked_context:
         recently_checked_context[toot['uri']] = toot
         return True
+    elif 'lastSeen' not in recently_checked_context[toot['uri']]:
+        # recorded, but not fetched yet, e.g. by an interrupted run
+        return True
     else:
         lastSeen = recently_checked_context[toot['uri']]['lastSeen']
         createdAt = recently_checked_context[toot['uri']]['created_at']
@@ -514,19 +608,36 @@ def toot_context_should_be_fetched(toot):
 def get_all_known_context_urls(server, reply_toots, parsed_urls, seen_hosts):
     """get the context toots of the given toots from their original server"""
     known_context_urls = set()
+    toots_to_fetch = []
 
     for toot in reply_toots:
         if toot_has_parseable_url(toot, parsed_urls):
             url = toot["url"] if toot["reblog"] is None else toot["reblog"]["url"]
             parsed_url = parse_url(url, parsed_urls)
             if toot_context_can_be_fetched(toot) and toot_context_should_be_fetched(toot):
-                recently_checked_context[toot['uri']]['lastSeen'] = datetime.now(datetime.now().astimezone().tzinfo)
-                context = get_toot_context(parsed_url[0], parsed_url[1], url, seen_hosts)
-                if context is not None:
-                    for item in context:
-                        known_context_urls.add(item)
-                else:
-                    logger.error(f"Error getting context for toot {url}")
+                toots_to_fetch.append((toot['uri'], parsed_url, url))
+
+    def fetch_context(toot):
+        uri, parsed_url, url = toot
+        if not RUN_BUDGET.allows('context') or not HOST_REQUESTS.allows(parsed_url[0]):
+            if 'lastSeen' not in recently_checked_context[uri]:
+                # forget about it, so that we check it next time
+                recently_checked_context.pop(uri)
+            return []
+
+        # a copy, so that the toot doesn't change while a checkpoint is saving it
+        checked = dict(recently_checked_context[uri])
+        checked['lastSeen'] = datetime.now(datetime.now().astimezone().tzinfo)
+        recently_checked_context[uri] = checked
+        context = get_toot_context(parsed_url[0], parsed_url[1], url, seen_hosts)
+        if context is None:
+            logger.error(f"Error getting context for toot {url}")
+            return []
+        return list(context)
+
+    bootstrap_hosts(server, [toot[1][0] for toot in toots_to_fetch], seen_hosts)
+    for context in run_concurrently(fetch_context, toots_to_fetch, host_of=lambda toot: toot[1][0]):
+        known_context_urls.update(context)
 
     known_context_urls = set(filter(lambda url: not url.startswith(f"https://{server}/"), known_context_urls))
     logger.info(f"Found {len(known_context_urls)} known context toots")
@@ -774,7 +885,7 @@ def parse_peertube_profile_url(url):
 def get_redirect_url(url):
     """get the URL given URL redirects to"""
     try:
-        resp = requests.head(url, allow_redirects=False, timeout=5,headers={
+        resp = HTTP_SESSIONS.get(url).head(url, allow_redirects=False, timeout=5,headers={
             'User-Agent': 'FediFetcher (https://go.thms.uk/mgr)'
         })
     except Exception as ex:
@@ -828,7 +939,9 @@ def get_toot_context(server, toot_id, toot_url, seen_hosts):
 def get_mastodon_urls(webserver, toot_id, toot_url):
     url = f"https://{webserver}/api/v1/statuses/{toot_id}/context"
     try:
-        resp = get(url)
+        resp = get(url, cache = True)
+    except RateLimitDeferred:
+        raise
     except Exception as ex:
         logger.error(f"Error getting context for toot {toot_url}. Exception: {ex}")
         return []
@@ -861,6 +974,8 @@ def get_lemmy_comment_context(webserver, toot_id, toot_url):
     comment = f"https://{webserver}/api/v3/comment?id={toot_id}"
     try:
         resp = get(comment)
+    except RateLimitDeferred:
+        raise
     except Exception as ex:
         logger.error(f"Error getting comment {toot_id} from {toot_url}. Exception: {ex}")
         return []
@@ -870,6 +985,8 @@ def get_lemmy_comment_context(webserver, toot_id, toot_url):
             res = resp.json()
             post_id = res['comment_view']['comment']['post_id']
             return get_lemmy_comments_urls(webserver, post_id, toot_url)
+        except RateLimitDeferred:
+            raise
         except Exception as ex:
             logger.error(f"Error parsing context for comment {toot_url}. Exception: {ex}")
         return []
@@ -880,6 +997,8 @@ def get_lemmy_comments_urls(webserver, post_id, toot_url):
     url = f"https://{webserver}/api/v3/post?id={post_id}"
     try:
         resp = get(url)
+    except RateLimitDeferred:
+        raise
     except Exception as ex:
         logger.error(f"Error getting post {post_id} from {toot_url}. Exception: {ex}")
         return []
@@ -896,6 +1015,8 @@ def get_lemmy_comments_urls(webserver, post_id, toot_url):
     url = f"https://{webserver}/api/v3/comment/list?post_id={post_id}&sort=New&limit=50"
     try:
         resp = get(url)
+    except RateLimitDeferred:
+        raise
     except Exception as ex:
         logger.error(f"Error getting comments for post {post_id} from {toot_url}. Exception: {ex}")
         return []
@@ -918,6 +1039,8 @@ def get_peertube_urls(webserver, post_id, toot_url):
     comments = f"https://{webserver}/api/v1/videos/{post_id}/comment-threads"
     try:
         resp = get(comments)
+    except RateLimitDeferred:
+        raise
     except Exception as ex:
         logger.error(f"Error getting comments on video {post_id} from {toot_url}. Exception: {ex}")
         return []
@@ -932,6 +1055,8 @@ def get_misskey_urls(webserver, post_id, toot_url):
     url = f"https://{webserver}/api/notes/children"
     try:
         resp = post(url, { 'noteId': post_id, 'limit': 100, 'depth': 12 })
+    except RateLimitDeferred:
+        raise
     except Exception as ex:
         logger.error(f"Error getting post {post_id} from {toot_url}. Exception: {ex}")
         return []
@@ -950,6 +1075,8 @@ def get_misskey_urls(webserver, post_id, toot_url):
     url = f"https://{webserver}/api/notes/conversation"
     try:
         resp = post(url, { 'noteId': post_id, 'limit': 100 })
+    except RateLimitDeferred:
+        raise
     except Exception as ex:
         logger.error(f"Error getting post {post_id} from {toot_url}. Exception: {ex}")
         return []
@@ -971,31 +1098,57 @@ def add_context_urls(server, access_token, context_urls, seen_urls):
     """add the given toot URLs to the server"""
     count = 0
     failed = 0
-    for url in context_urls:
-        if url not in seen_urls:
-            added = add_context_url(url, server, access_token)
-            if added is True:
-                seen_urls.add(url)
-                count += 1
-            else:
-                failed += 1
+    dropped = 0
+    urls = [url for url in dict.fromkeys(context_urls) if url not in seen_urls]
+    PENDING_WORK.add_urls(access_token, urls)
+
+    def resolve(url):
+        if not RUN_BUDGET.allows('resolve'):
+            return None
+        added = add_context_url(url, server, access_token)
+        if added is True:
+            seen_urls.add(url)
+        PENDING_WORK.resolved(access_token, url)
+        return added
+
+    for url, added in zip(urls, RESOLVE_POOL.map(resolve, urls)):
+        if added is True:
+            count += 1
+        elif added is None:
+            dropped += 1
+        else:
+            failed += 1
 
     logger.info(f"Added {count} new context toots (with {failed} failures)")
+    if dropped > 0:
+        logger.info(f"Skipped {dropped} context toots to stay within --max-runtime")
 
 
 def add_context_url(url, server, access_token):
     """add the given toot URL to the server"""
     search_url = f"https://{server}/api/v2/search?q={url}&resolve=true&limit=1"
+    access_token = RESOLVE_TOKENS.pick(server, access_token)
 
+    RESOLVE_LIMIT.acquire()
+    start = time.monotonic()
+    LAST_REQUEST.round_trip = None
+    LAST_REQUEST.congested = False
+    resp = None
     try:
         resp = get(search_url, headers={
             "Authorization": f"Bearer {access_token}",
         })
+    except RateLimitDeferred:
+        raise
     except Exception as ex:
         logger.error(
             f"Error adding url {search_url} to server {server}. Exception: {ex}"
         )
         return False
+    finally:
+        # only the network time counts, not the time we held back to pace requests or waited to retry them
+        latency = LAST_REQUEST.round_trip if LAST_REQUEST.round_trip is not None else time.monotonic() - start
+        RESOLVE_LIMIT.release(latency, resp is not None and not LAST_REQUEST.congested and resp.status_code != 429 and resp.status_code < 500)
 
     if resp.status_code == 200:
         logger.debug(f"Added context url {url}")
@@ -1059,22 +1212,16 @@ def get_paginated_mastodon(url, max, headers = {}, timeout = 0, max_tries = 5):
                 break
     return result
 
-def get_robots_txt_cache_path(robots_url):
-    hash = xxhash.xxh128(robots_url.encode('utf-8'))
-    return os.path.join(arguments.state_dir, f'robots-{hash.hexdigest()}.txt')
-
 def get_cached_robots(robots_url):
     ## firstly: check the in-memory cache
     if robots_url in ROBOTS_TXT:
         return ROBOTS_TXT[robots_url]
 
-    robotsCachePath = get_robots_txt_cache_path(robots_url)
-    if os.path.exists(robotsCachePath):
-        with open(robotsCachePath, "r", encoding="utf-8") as f:
-            logger.debug(f"Getting robots.txt file from cache for {robots_url}.")
-            robotsTxt = f.read()
-            ROBOTS_TXT[robots_url] = robotsTxt
-            return robotsTxt
+    robotsTxt = ROBOTS_STORE.get(robots_url)
+    if robotsTxt is not None:
+        logger.debug(f"Getting robots.txt file from cache for {robots_url}.")
+        ROBOTS_TXT[robots_url] = robotsTxt
+        return robotsTxt
 
     return None
 
@@ -1085,14 +1232,15 @@ def get_robots_from_url(robots_url):
 
     try:
         # We are getting the robots.txt manually from here, because otherwise we can't change the User Agent
-        robotsTxt = get(robots_url, timeout = 2, ignore_robots_txt=True)
+        robotsTxt = get(robots_url, timeout = 2, ignore_robots_txt=True, cache=True)
         if robotsTxt.status_code in (401, 403):
             robotsTxt = False
         else:
+            ROBOTS_STORE.put(robots_url, robotsTxt.text, robotsTxt.headers)
             robotsTxt = robotsTxt.text
-            with open(get_robots_txt_cache_path(robots_url), "w", encoding="utf-8") as f:
-                f.write(robotsTxt)
 
+    except RateLimitDeferred:
+        raise
     except Exception:
         robotsTxt = True
 
@@ -1100,6 +1248,88 @@ def get_robots_from_url(robots_url):
     return robotsTxt
 
 
+class DomainBlocklist:
+    """The domains FediFetcher won't connect to. A domain can be blocked on its own, or along with all its subdomains"""
+
+    def __init__(self, domains = ()):
+        self.domains = set()
+        self.suffixes = set()
+        for domain in domains:
+            self.add(domain)
+
+    def add(self, domain, subdomains = False):
+        """Block domain, and all its subdomains if subdomains is True, or domain is given as *.domain"""
+        domain = domain.strip().lower().rstrip('.')
+        if domain.startswith('*.'):
+            self.suffixes.add(domain[2:])
+        elif domain:
+            self.domains.add(domain)
+            if subdomains:
+                self.suffixes.add(domain)
+
+    def __contains__(self, netloc):
+        netloc = netloc.lower()
+        if netloc in self.domains:
+            return True
+        host = netloc.rsplit(':', 1)[0] if ':' in netloc and not netloc.endswith(']') else netloc
+        if host in self.domains:
+            return True
+        # check every parent domain, so that lookups don't depend on how many domains are blocked
+        index = host.find('.')
+        while index != -1:
+            if host[index + 1:] in self.suffixes:
+                return True
+            index = host.find('.', index + 1)
+        return False
+
+    def __len__(self):
+        return len(self.domains | self.suffixes)
+
+
+INSTANCE_BLOCKLIST = DomainBlocklist()
+
+
+def read_domain_blocks_csv(path):
+    """The suspended domains in a Mastodon domain blocks export, or in a file with one domain per line"""
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        rows = [row for row in csv.reader(f) if row and row[0].strip()]
+    if len(rows) == 0:
+        return []
+    if rows[0][0].strip().lstrip('#') == 'domain':
+        columns = [column.strip().lstrip('#') for column in rows[0]]
+        return [
+            row[0] for row in rows[1:]
+            if 'severity' not in columns or row[columns.index('severity')].strip() == 'suspend'
+        ]
+    return [row[0] for row in rows]
+
+
+def get_server_domain_blocks(server, access_token, cache_file, ttl_hours):
+    """The domains our server suspended, from the admin API, or from cache_file if we fetched them within the last ttl_hours"""
+    cached = None
+    if os.path.exists(cache_file):
+        with open(cache_file, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        if cached['fetched'] + ttl_hours * 60 * 60 > time.time():
+            return cached['domains']
+
+    try:
+        blocks = get_paginated_mastodon(f"https://{server}/api/v1/admin/domain_blocks", 100000, {
+            "Authorization": f"Bearer {access_token}",
+        })
+    except Exception as ex:
+        if cached is None:
+            logger.warning(f"Error getting domain blocks from {server}. Make sure your access token has the admin:read:domain_blocks scope. Exception: {ex}")
+            return []
+        logger.warning(f"Error getting domain blocks from {server}. Using the ones we got {round((time.time() - cached['fetched']) / 3600)} hours ago. Exception: {ex}")
+        return cached['domains']
+
+    domains = [block['domain'] for block in blocks if block.get('severity') == 'suspend']
+    with open(cache_file, "w", encoding="utf-8") as f:
+        json.dump({'fetched': time.time(), 'domains': domains}, f)
+    return domains
+
+
 def can_fetch(user_agent, url):
     parsed_uri = urlparse(url)
     robots_url = '{uri.scheme}://{uri.netloc}/robots.txt'.format(uri=parsed_uri)
@@ -1112,16 +1342,186 @@ def can_fetch(user_agent, url):
     if isinstance(robotsTxt, bool):
         return robotsTxt
 
-    robotParser = urllib.robotparser.RobotFileParser()
-    robotParser.parse(robotsTxt.splitlines())
-    return robotParser.can_fetch(user_agent, url)
+    rules = ROBOT_RULES.get(robots_url)
+    if rules is None or rules.robotsTxt != robotsTxt:
+        rules = RobotRules(robotsTxt)
+        ROBOT_RULES[robots_url] = rules
+        RATE_LIMITER.set_crawl_delay(parsed_uri.netloc, rules.parser.crawl_delay(user_agent))
+    return rules.can_fetch(user_agent, url, parsed_uri)
+
+
+class RobotsStore:
+    """The robots.txt files we downloaded, with when we fetched them, and for how long we may use them.
+    Expired entries are dropped when they are next looked up, or when the store is saved.
+    Entries are kept in a dict, or in a SqliteDict with --state-db"""
+
+    DEFAULT_TTL = 24 * 60 * 60
+    MIN_TTL = 60 * 60
+    MAX_TTL = 7 * 24 * 60 * 60
+
+    def __init__(self, entries = None):
+        self.entries = entries if entries is not None else {}
+        self._lock = threading.Lock()
+
+    def load(self, entries):
+        """Add saved entries, without replacing any robots.txt we fetched in the meantime"""
+        with self._lock:
+            for robots_url, entry in entries.items():
+                if robots_url not in self.entries:
+                    self.entries[robots_url] = entry
+
+    def get(self, robots_url):
+        with self._lock:
+            entry = self.entries.get(robots_url)
+            if entry is None:
+                return None
+            if entry['fetched'] + entry['ttl'] <= time.time():
+                self.entries.pop(robots_url)
+                return None
+            return entry['text']
+
+    def put(self, robots_url, text, headers = {}):
+        """Store a robots.txt file for as long as its Cache-Control max-age allows, within reason"""
+        ttl = self.DEFAULT_TTL
+        max_age = parse_cache_control(headers.get('Cache-Control', '')).get('max-age')
+        if max_age is not None and max_age.isdigit():
+            ttl = min(max(int(max_age), self.MIN_TTL), self.MAX_TTL)
+        with self._lock:
+            self.entries[robots_url] = {'text': text, 'fetched': round(time.time()), 'ttl': ttl}
+
+    def toJSON(self):
+        now = time.time()
+        with self._lock:
+            return json.dumps({
+                robots_url: entry
+                for robots_url, entry in self.entries.items()
+                if entry['fetched'] + entry['ttl'] > now
+            })
+
+
+class JournaledRobotsStore(RobotsStore):
+    """A RobotsStore in a file with one JSON encoded entry per line. Stored robots.txt files are appended to the file,
+    which is only rewritten, without the replaced and expired entries, once it holds more than twice as many lines as entries"""
+
+    COMPACT_AT = 1000
+
+    def __init__(self, path):
+        entries, self.lines = self._read(path)
+        super().__init__(entries)
+        self.path = path
+        self._file = None
+        self._journal_lock = threading.Lock()
+
+    @staticmethod
+    def _read(path):
+        """The unexpired entries in a robots file, and how many lines it has"""
+        entries = {}
+        lines = 0
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                content = f.read()
+            if content.startswith('{'):
+                # earlier versions wrote all entries as a single JSON object, which the first save turns into a journal
+                entries = json.loads(content)
+                lines = float('inf')
+            else:
+                for line in content.splitlines():
+                    if line:
+                        robots_url, entry = json.loads(line)
+                        entries[robots_url] = entry
+                        lines += 1
+        now = time.time()
+        return {robots_url: entry for robots_url, entry in entries.items() if entry['fetched'] + entry['ttl'] > now}, lines
+
+    @classmethod
+    def read(cls, path):
+        """The unexpired entries in a robots file"""
+        return cls._read(path)[0]
+
+    def put(self, robots_url, text, headers = {}):
+        super().put(robots_url, text, headers)
+        with self._lock:
+            entry = self.entries.get(robots_url)
+        with self._journal_lock:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(json.dumps([robots_url, entry]) + "\n")
+            self.lines += 1
+
+    def save(self):
+        """Write any appended entries to disk, and compact the file if it grew too large"""
+        with self._journal_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            elif not os.path.exists(self.path):
+                # an empty store, so that the next run knows the old per host files are gone
+                open(self.path, "a", encoding="utf-8").close()
+            with self._lock:
+                entries = len(self.entries)
+            if self.lines > max(2 * entries, self.COMPACT_AT):
+                now = time.time()
+                with self._lock:
+                    lines = [json.dumps([robots_url, entry]) + "\n" for robots_url, entry in self.entries.items() if entry['fetched'] + entry['ttl'] > now]
+                with open(f"{self.path}.tmp", "w", encoding="utf-8") as f:
+                    f.write("".join(lines))
+                os.replace(f"{self.path}.tmp", self.path)
+                self.lines = len(lines)
+
+
+ROBOTS_STORE = RobotsStore()
+
+
+class RobotRules:
+    """A parsed robots.txt file, which remembers its answers.
+
+    RobotFileParser only matches rules as prefixes of the (normalised) path, so two paths that
+    share their first n characters, where n is the length of the longest rule, get the same answer"""
+
+    MAX_ANSWERS = 10000
+
+    def __init__(self, robotsTxt):
+        self.robotsTxt = robotsTxt
+        self.parser = urllib.robotparser.RobotFileParser()
+        self.parser.parse(robotsTxt.splitlines())
+        entries = list(self.parser.entries) + ([self.parser.default_entry] if self.parser.default_entry else [])
+        self.prefix_length = max([len(rule.path) for entry in entries for rule in entry.rulelines], default=0)
+        self.answers = {}
+
+    def can_fetch(self, user_agent, url, parsed_url = None):
+        key = (user_agent, robots_path(url, parsed_url)[:self.prefix_length])
+        answer = self.answers.get(key)
+        if answer is None:
+            answer = self.parser.can_fetch(user_agent, url)
+            if len(self.answers) >= self.MAX_ANSWERS:
+                self.answers.clear()
+            self.answers[key] = answer
+        return answer
+
+
+ROBOT_RULES = {}
+
+
+ROBOTS_SAFE_PATH = re.compile(r"[A-Za-z0-9/_.~-]*")
+
+def robots_path(url, parsed_url = None):
+    """The path of url as RobotFileParser matches it against the rules in robots.txt"""
+    if parsed_url is None:
+        parsed_url = urlparse(url)
+    if not (parsed_url.params or parsed_url.query or parsed_url.fragment) and ROBOTS_SAFE_PATH.fullmatch(parsed_url.path):
+        # nothing to unquote or quote, which is true for nearly all API requests
+        return parsed_url.path or "/"
+    parsed_url = urlparse(unquote(url))
+    path = quote(urlunparse(('', '', parsed_url.path, parsed_url.params, parsed_url.query, parsed_url.fragment)))
+    return path or "/"
 
 
 def user_agent():
     return f"FediFetcher/{VERSION}; +{arguments.server} (https://go.thms.uk/ff)"
 
-def get(url, headers = {}, timeout = 0, max_tries = 5, backoff = 0.5, ignore_robots_txt = False):
-    """A simple wrapper to make a get request while providing our user agent, and respecting rate limits"""
+def get(url, headers = {}, timeout = 0, max_tries = 5, backoff = 0.5, ignore_robots_txt = False, cache = False):
+    """A simple wrapper to make a get request while providing our user agent, and respecting rate limits.
+    Set cache to True to serve and revalidate unauthenticated responses from the HTTP cache"""
     h = headers.copy()
     if 'User-Agent' not in h:
         h['User-Agent'] = user_agent()
@@ -1132,21 +1532,24 @@ def get(url, headers = {}, timeout = 0, max_tries = 5, backoff = 0.5, ignore_rob
     if timeout == 0:
         timeout = arguments.http_timeout
 
-    response = requests.get( url, headers= h, timeout=timeout)
-    if response.status_code == 429:
-        if max_tries > 0:
-            now = datetime.now(datetime.now().astimezone().tzinfo)
-            if 'x-ratelimit-reset' in response.headers:
-                reset = parser.parse(response.headers['x-ratelimit-reset'])
-                wait = (reset - now).total_seconds() + 1
-            else:
-                wait = backoff
-                reset = now + timedelta(seconds=wait)
-            logger.warning(f"Rate Limit hit requesting {url}. Waiting {wait} sec to retry at {reset}")
-            time.sleep(wait)
-            return get(url, headers, timeout, max_tries - 1, backoff * 4)
+    # Identical requests that are already in flight share their response, rather than being sent again
+    return IN_FLIGHT.do((url, tuple(sorted(h.items()))), lambda: get_response(url, h, timeout, max_tries, backoff, cache))
 
-        raise Exception(f"Maximum number of retries exceeded for rate limited request {url}")
+def get_response(url, headers, timeout, max_tries, backoff, cache):
+    h = headers.copy()
+    cached = None
+    if cache and 'Authorization' not in h:
+        cached = HTTP_CACHE.lookup(url)
+        if cached is not None:
+            if HTTP_CACHE.is_fresh(cached):
+                return HTTP_CACHE.serve(url, cached)
+            h.update(HTTP_CACHE.validators(cached))
+
+    response = send_request('get', url, h, timeout, max_tries, backoff)
+    if cached is not None and response.status_code == 304:
+        return HTTP_CACHE.revalidate(url, cached, response)
+    if cache and 'Authorization' not in h and response.status_code == 200:
+        HTTP_CACHE.store(url, response)
     return response
 
 def build_callback_url(url, params):
@@ -1169,26 +1572,1278 @@ def post(url, json, headers = {}, timeout = 0, max_tries = 5, backoff = 0.5):
     if timeout == 0:
         timeout = arguments.http_timeout
 
-    response = requests.post( url, json=json, headers= h, timeout=timeout)
-    if response.status_code == 429:
-        if max_tries > 0:
-            now = datetime.now(datetime.now().astimezone().tzinfo)
-            if 'x-ratelimit-reset' in response.headers:
-                reset = parser.parse(response.headers['x-ratelimit-reset'])
-                wait = (reset - now).total_seconds() + 1
-            else:
-                wait = backoff
-                reset = now + timedelta(seconds=wait)
-            logger.warning(f"Rate Limit hit requesting {url}. Waiting {wait} sec to retry at {reset}")
+    return send_request('post', url, h, timeout, max_tries, backoff, json=json)
+
+def send_request(method, url, headers, timeout, max_tries = 5, backoff = 0.5, **kwargs):
+    """Send a request through the host's session, retrying rate limited requests up to max_tries times,
+    and timeouts, connection errors and 502/503/504 responses according to the retry policy.
+    timeout is the read timeout to use for hosts we don't know enough about yet"""
+    host = urlparse(url).netloc
+    limiter_key = rate_limit_key(url, headers)
+    rate_limited = 0
+    attempt = 0
+    LAST_REQUEST.round_trip = None
+    LAST_REQUEST.congested = False
+
+    while True:
+        if not CIRCUIT_BREAKER.allow(host):
+            raise Exception(f"Not querying {url}: {host} has been failing repeatedly")
+        if not HOST_REQUESTS.take(host):
+            raise Exception(f"Not querying {url}: reached --max-requests-per-host for {host}")
+
+        RATE_LIMITER.wait(limiter_key)
+        request_timeout = RUN_BUDGET.timeout(HOST_TIMEOUTS.timeout(host, timeout))
+        sent = time.monotonic()
+        try:
+            response = getattr(HTTP_SESSIONS.get(url), method)(url, headers=headers, timeout=request_timeout, **kwargs)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as ex:
+            LAST_REQUEST.congested = True
+            if isinstance(ex, requests.exceptions.ReadTimeout):
+                HOST_TIMEOUTS.record_timeout(host)
+            CIRCUIT_BREAKER.record(host, False)
+            wait = RETRY_POLICY.backoff(attempt, backoff)
+            if not RETRY_POLICY.should_retry(attempt, wait):
+                raise
+            logger.warning(f"Error requesting {url}: {ex}. Retrying in {wait:.1f} sec")
             time.sleep(wait)
-            return post(url, json, headers, timeout, max_tries - 1, backoff * 4)
+            attempt += 1
+            continue
+
+        LAST_REQUEST.round_trip = time.monotonic() - sent
+        if response.status_code == 429 or response.status_code >= 500:
+            LAST_REQUEST.congested = True
+        CIRCUIT_BREAKER.record(host, response.status_code < 500)
+        RATE_LIMITER.update(limiter_key, response.headers)
+        if response.status_code < 500:
+            HOST_TIMEOUTS.record(host, LAST_REQUEST.round_trip)
+
+        if response.status_code == 429:
+            if rate_limited >= max_tries:
+                raise Exception(f"Maximum number of retries exceeded for rate limited request {url}")
+            wait = parse_retry_after(response.headers.get('retry-after'))
+            if wait is None and 'x-ratelimit-reset' in response.headers:
+                reset = parse_rate_limit_reset(response.headers['x-ratelimit-reset'])
+                if reset is not None:
+                    wait = reset - time.time() + 1
+            if wait is None:
+                wait = backoff * 4 ** rate_limited
+            RATE_LIMITER.block(limiter_key, time.time() + wait)
+            wait_or_defer(max(wait, 0), f"Rate Limit hit requesting {url}", logging.WARNING)
+            rate_limited += 1
+            continue
+
+        if response.status_code in RetryPolicy.RETRY_STATUS_CODES:
+            wait = parse_retry_after(response.headers.get('retry-after'))
+            if wait is None:
+                wait = RETRY_POLICY.backoff(attempt, backoff)
+            if RETRY_POLICY.should_retry(attempt, wait):
+                logger.warning(f"Got status code {response.status_code} requesting {url}. Retrying in {wait:.1f} sec")
+                time.sleep(wait)
+                attempt += 1
+                continue
+
+        return response
+
+def parse_retry_after(value):
+    """Turn a Retry-After header, which is either a number of seconds or a date, into a number of seconds"""
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parser.parse(value).timestamp() - time.time(), 0)
+    except (ValueError, OverflowError):
+        return None
+
+
+class RetryPolicy:
+    """Decides whether a failed request is retried, and how long to wait before doing so.
+    Retries use capped exponential backoff with jitter, and are limited per request and per run."""
+
+    RETRY_STATUS_CODES = (502, 503, 504)
+
+    def __init__(self, max_retries = 2, budget = 100, max_backoff = 30):
+        self.max_retries = max_retries
+        self.budget = budget
+        self.max_backoff = max_backoff
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def backoff(self, attempt, base):
+        wait = min(self.max_backoff, base * 2 ** attempt)
+        return wait / 2 + random.uniform(0, wait / 2)
+
+    def should_retry(self, attempt, wait):
+        if attempt >= self.max_retries or wait > self.max_backoff:
+            return False
+        remaining = RUN_BUDGET.remaining()
+        if remaining is not None and wait >= remaining:
+            return False
+        with self._lock:
+            if self.retries >= self.budget:
+                if self.retries == self.budget:
+                    logger.warning("Retry budget for this run is used up. Failed requests will no longer be retried")
+                    self.retries += 1
+                return False
+            self.retries += 1
+            return True
+
+
+RETRY_POLICY = RetryPolicy()
+
+
+def run_concurrently(func, items, concurrency = None, host_of = None):
+    """Call func for each of the given items, running up to `concurrency` calls at the same time, and return the results in order.
+    If host_of is given, items are started round-robin across the hosts it returns for them, rather than in order"""
+    items = list(items)
+    if concurrency is None:
+        concurrency = CONCURRENCY
+
+    order = interleave_by_host(items, host_of) if host_of is not None else list(range(len(items)))
+    ordered_items = [items[index] for index in order]
+
+    # Work started from within a worker runs inline, so nested calls don't multiply the number of concurrent requests
+    if len(items) == 0 or threading.current_thread() is not threading.main_thread() or getattr(WORK_CONTEXT, 'running', False):
+        ordered_results = [func(item) for item in ordered_items]
+    elif concurrency <= 1:
+        ordered_results = run_inline(func, ordered_items)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(concurrency, 1), thread_name_prefix="FediFetcher") as executor:
+            ordered_results = asyncio.run(run_in_workers(func, ordered_items, max(concurrency, 1), executor))
+
+    results = [None] * len(items)
+    for index, result in zip(order, ordered_results):
+        results[index] = result
+    return results
+
+def interleave_by_host(items, host_of):
+    """Return the indexes of items ordered round-robin across their hosts, keeping the order of items within each host"""
+    by_host = OrderedDict()
+    for index, item in enumerate(items):
+        by_host.setdefault(host_of(item), []).append(index)
+    return [index for group in itertools.zip_longest(*by_host.values()) for index in group if index is not None]
+
+async def run_in_workers(func, items, concurrency, executor):
+    """Run func for each item on the executor. Items that hit a rate limit are deferred until the limit resets,
+    without holding up a worker, so that work for other hosts can continue in the meantime"""
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(item):
+        for deferrals in itertools.count():
+            async with semaphore:
+                result, deferred_until = await loop.run_in_executor(executor, run_deferrable, func, item, deferrals < MAX_DEFERRALS)
+            if deferred_until is None:
+                return result
+            await asyncio.sleep(max(deferred_until - time.time(), 0))
+
+    return await asyncio.gather(*(run(item) for item in items))
+
+def run_inline(func, items):
+    """run_in_workers with a single worker, on the calling thread. Items that hit a rate limit are deferred
+    until the limit resets, while the items after them carry on"""
+    results = [None] * len(items)
+    ready = list(reversed(range(len(items))))
+    deferred = []
+    deferrals = [0] * len(items)
+    while ready or deferred:
+        if deferred and (not ready or deferred[0][0] <= time.time()):
+            deferred_until, index = heapq.heappop(deferred)
+            time.sleep(max(deferred_until - time.time(), 0))
+        else:
+            index = ready.pop()
+        result, deferred_until = run_deferrable(func, items[index], deferrals[index] < MAX_DEFERRALS)
+        if deferred_until is None:
+            results[index] = result
+        else:
+            deferrals[index] += 1
+            heapq.heappush(deferred, (deferred_until, index))
+    return results
+
+def run_deferrable(func, item, deferrable = True):
+    """Call func for item, and return its result, and the time until which it has to be deferred, if it ran into a rate limit"""
+    # items run inline can start other work, so we put back the context of the item that started us when we're done
+    outer = (getattr(WORK_CONTEXT, 'deferrable', False), getattr(WORK_CONTEXT, 'deferred_until', None), getattr(WORK_CONTEXT, 'running', False))
+    WORK_CONTEXT.deferrable = deferrable
+    WORK_CONTEXT.deferred_until = None
+    WORK_CONTEXT.running = True
+    result = None
+    try:
+        result = func(item)
+    except RateLimitDeferred:
+        pass
+    finally:
+        deferred_until = WORK_CONTEXT.deferred_until
+        WORK_CONTEXT.deferrable, WORK_CONTEXT.deferred_until, WORK_CONTEXT.running = outer
+    if deferred_until is not None:
+        return None, deferred_until
+    return result, None
+
+def wait_or_defer(seconds, reason, level = logging.DEBUG):
+    """Sleep for the given time. Inside a work item that can be deferred, long waits instead abort the item,
+    so that it can be retried once the wait is over, while the worker gets on with other work"""
+    if seconds <= 0:
+        return
+    if seconds > DEFER_THRESHOLD and getattr(WORK_CONTEXT, 'deferrable', False):
+        WORK_CONTEXT.deferred_until = max(WORK_CONTEXT.deferred_until or 0, time.time() + seconds)
+        logger.log(level, f"{reason}. Deferring this for {seconds:.1f} sec and carrying on with other work")
+        raise RateLimitDeferred(f"{reason}. Deferred for {seconds:.1f} sec")
+    logger.log(level, f"{reason}. Waiting {seconds:.1f} sec to retry at {datetime.now() + timedelta(seconds=seconds)}")
+    time.sleep(seconds)
+
+
+class RateLimitDeferred(Exception):
+    pass
+
+
+class SingleFlight:
+    """Lets concurrent calls with the same key share a single execution, and its result"""
+
+    def __init__(self):
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {'done': threading.Event(), 'result': None, 'error': None}
+                self._calls[key] = call
+            else:
+                self.shared += 1
+
+        if not leader:
+            call['done'].wait()
+            if isinstance(call['error'], RateLimitDeferred):
+                # the deferral belongs to the leader's work item, so we decide for ourselves whether to wait or defer
+                return func()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = func()
+            return call['result']
+        except Exception as ex:
+            call['error'] = ex
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key)
+            call['done'].set()
+
+
+CONCURRENCY = 1
+DEFER_THRESHOLD = 5
+MAX_DEFERRALS = 5
+WORK_CONTEXT = threading.local()
+# the network time of the last request sent on this thread, and whether it ran into a 429, 5xx or error on the way
+LAST_REQUEST = threading.local()
+IN_FLIGHT = SingleFlight()
+
+
+class WorkerPool:
+    """A fixed-size pool of worker threads, shared by everything submitting one kind of work, no matter which thread it's submitted from"""
+
+    def __init__(self, max_workers = 1, name = "FediFetcher"):
+        self.max_workers = max_workers
+        self.name = name
+        self._executor = None
+        self._lock = threading.Lock()
+        self._inline_lock = threading.RLock()
+
+    def map(self, func, items):
+        """Call func for each of the given items on the pool, and return the results in order.
+        A pool of a single worker runs them on the calling thread, one at a time across all threads"""
+        items = list(items)
+        if len(items) == 0:
+            return []
+
+        if self.max_workers <= 1:
+            def run_one(item):
+                with self._inline_lock:
+                    return func(item)
+            return run_inline(run_one, items)
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(self.max_workers, 1), thread_name_prefix=self.name)
+        return asyncio.run(run_in_workers(func, items, max(self.max_workers, 1), self._executor))
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+RESOLVE_POOL = WorkerPool(1, "FediFetcher-resolve")
+
+
+class AdaptiveConcurrency:
+    """Limits how many requests run at the same time using additive increase, multiplicative decrease:
+    the limit grows by one after every window of requests whose p95 latency stays within the target,
+    and halves when latency goes over the target, or a request fails"""
+
+    MIN_WINDOW = 5
+
+    def __init__(self, maximum = 1, target_latency = 0, minimum = 1):
+        self.maximum = max(maximum, 1)
+        self.minimum = max(min(minimum, self.maximum), 1)
+        self.target_latency = target_latency
+        self.limit = self.minimum if target_latency > 0 else self.maximum
+        self.active = 0
+        self._samples = []
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.active >= self.limit:
+                self._condition.wait()
+            self.active += 1
+
+    def release(self, seconds, success = True):
+        """Free a slot, and adjust the limit based on how the request went"""
+        with self._condition:
+            self.active -= 1
+            if self.target_latency > 0:
+                if not success:
+                    self._decrease()
+                else:
+                    self._samples.append(seconds)
+                    if len(self._samples) >= max(self.limit, self.MIN_WINDOW):
+                        samples = sorted(self._samples)
+                        p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+                        if p95 > self.target_latency:
+                            self._decrease()
+                        else:
+                            self.limit = min(self.limit + 1, self.maximum)
+                            self._samples = []
+            self._condition.notify_all()
+
+    def _decrease(self):
+        self.limit = max(self.limit // 2, self.minimum)
+        self._samples = []
+
+
+RESOLVE_LIMIT = AdaptiveConcurrency()
+
+
+def rate_limit_key(url, headers):
+    """Rate limits apply per host, and on Mastodon additionally per access token"""
+    host = urlparse(url).netloc
+    if 'Authorization' in headers:
+        return (host, xxhash.xxh64(headers['Authorization'].encode('utf-8')).hexdigest())
+    return (host, None)
+
+def parse_rate_limit_reset(value):
+    """Turn an X-RateLimit-Reset header into a unix timestamp. Servers send either a date, a unix timestamp, or a number of seconds"""
+    try:
+        seconds = float(value)
+        return seconds if seconds > 10 ** 9 else time.time() + seconds
+    except ValueError:
+        pass
+    try:
+        return parser.parse(value).timestamp()
+    except (ValueError, OverflowError):
+        return None
+
+
+class HostRateLimiter:
+    """Paces requests to each host, based on the rate limit headers it sends us and its robots.txt Crawl-delay"""
+
+    def __init__(self, pacing = 50):
+        self.pacing = pacing
+        self._limits = {}
+        self._crawl_delays = {}
+        self._next_request = {}
+        self._lock = threading.Lock()
+
+    def set_crawl_delay(self, host, delay):
+        if isinstance(delay, (int, float)) and delay > 0:
+            self._crawl_delays[host] = delay
+
+    def update(self, key, headers):
+        """Learn the remaining budget for key from a response's rate limit headers"""
+        remaining = headers.get('x-ratelimit-remaining')
+        reset = headers.get('x-ratelimit-reset')
+        if remaining is None or reset is None:
+            return
+        reset = parse_rate_limit_reset(reset)
+        try:
+            remaining = int(float(remaining))
+            limit = int(float(headers.get('x-ratelimit-limit', 0)))
+        except ValueError:
+            return
+        if reset is None:
+            return
+        with self._lock:
+            self._limits[key] = {'limit': limit, 'remaining': remaining, 'reset': reset}
+
+    def block(self, key, until):
+        """Hold back any requests for key until the given unix timestamp, e.g. after a 429 without rate limit headers"""
+        with self._lock:
+            budget = self._limits.get(key)
+            if budget is None or budget['remaining'] > 0 or budget['reset'] < until:
+                self._limits[key] = {'limit': budget['limit'] if budget else 0, 'remaining': 0, 'reset': until}
+
+    def load(self, entries):
+        """Restore the budgets of a previous run that haven't reset yet"""
+        now = time.time()
+        for entry in entries:
+            if entry['reset'] > now:
+                self._limits[(entry['host'], entry['token'])] = {
+                    'limit': entry['limit'],
+                    'remaining': entry['remaining'],
+                    'reset': entry['reset'],
+                }
+
+    def toJSON(self):
+        now = time.time()
+        with self._lock:
+            return json.dumps([
+                {'host': key[0], 'token': key[1], **budget}
+                for key, budget in self._limits.items()
+                if budget['reset'] > now
+            ])
+
+    def budget(self, key):
+        """The current rate limit budget for key, or None if we don't know it"""
+        with self._lock:
+            budget = self._limits.get(key)
+            if budget is None or budget['reset'] <= time.time():
+                return None
+            return dict(budget)
+
+    def exhausted(self):
+        """The hosts whose rate limit is currently used up"""
+        now = time.time()
+        return {key[0] for key, budget in list(self._limits.items()) if budget['remaining'] <= 0 and budget['reset'] > now}
+
+    def delay(self, key):
+        """Reserve the next request slot for key, and return how many seconds to wait for it"""
+        return self._reserve(key)[0]
+
+    def _reserve(self, key):
+        now = time.time()
+        with self._lock:
+            interval = self._crawl_delays.get(key[0], 0)
+            start = max(now, self._next_request.get(key, now))
+
+            budget = self._limits.get(key)
+            spent = None
+            if budget is not None:
+                if budget['reset'] <= now:
+                    # the window has reset, so we'll learn the new budget from the next response
+                    self._limits.pop(key)
+                elif budget['remaining'] <= 0:
+                    start = max(start, budget['reset'])
+                else:
+                    if budget['limit'] > 0 and budget['remaining'] * 100 < budget['limit'] * self.pacing:
+                        interval = max(interval, (budget['reset'] - now) / budget['remaining'])
+                    budget['remaining'] -= 1
+                    spent = budget
+
+            reservation = (self._next_request.get(key), start + interval, spent)
+            self._next_request[key] = start + interval
+        return start - now, reservation
+
+    def _release(self, key, reservation):
+        """Give back a slot we reserved but won't use"""
+        previous, reserved, spent = reservation
+        with self._lock:
+            # later requests reserved the slots after ours, which they keep
+            if self._next_request.get(key) == reserved:
+                if previous is None:
+                    self._next_request.pop(key)
+                else:
+                    self._next_request[key] = previous
+            if spent is not None and self._limits.get(key) is spent:
+                spent['remaining'] += 1
+
+    def wait(self, key):
+        """Block until we may send the next request for key. If the request is deferred instead, its slot is given back"""
+        seconds, reservation = self._reserve(key)
+        try:
+            wait_or_defer(seconds, f"Pacing requests to {key[0]}")
+        except RateLimitDeferred:
+            self._release(key, reservation)
+            raise
+
+
+RATE_LIMITER = HostRateLimiter()
+
+
+class TokenPool:
+    """Spreads requests to our own server across several access tokens, each of which has its own rate limit"""
+
+    def __init__(self, tokens = ()):
+        self.tokens = list(dict.fromkeys(tokens))
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def pick(self, server, access_token):
+        """Choose the token with the most rate limit budget left, taking turns between tokens we know nothing about yet"""
+        if len(self.tokens) < 2:
+            return access_token
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % len(self.tokens)
+        candidates = self.tokens[start:] + self.tokens[:start]
+
+        def score(token):
+            budget = RATE_LIMITER.budget(rate_limit_key(f"https://{server}/", {"Authorization": f"Bearer {token}"}))
+            if budget is None:
+                return (1, math.inf, 0)
+            if budget['remaining'] > 0:
+                return (1, budget['remaining'], 0)
+            # all used up: prefer the token that resets first
+            return (0, 0, -budget['reset'])
+
+        return max(candidates, key=score)
+
+
+RESOLVE_TOKENS = TokenPool()
+
+
+class PendingWork:
+    """The context toots we still have to add to our server, and the users whose posts we still have to backfill, per access token.
+    Users we follow are kept apart from other users, as they are remembered in known_followings once backfilled.
+    This is saved with the state, so that the next run can pick up where an interrupted run stopped.
+    Access tokens are only stored as hashes"""
+
+    MAX_AGE = 24 * 60 * 60
+
+    def __init__(self):
+        self._work = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, access_token):
+        key = xxhash.xxh64(access_token.encode('utf-8')).hexdigest()
+        return self._work.setdefault(key, {'resolve': {}, 'backfill': {}, 'followed': {}, 'time': time.time()})
+
+    def add_urls(self, access_token, urls):
+        with self._lock:
+            entry = self._entry(access_token)
+            entry['resolve'].update(dict.fromkeys(urls))
+            entry['time'] = time.time()
+
+    def resolved(self, access_token, url):
+        with self._lock:
+            self._entry(access_token)['resolve'].pop(url, None)
+
+    def add_users(self, access_token, users, followed = False):
+        with self._lock:
+            entry = self._entry(access_token)
+            entry['followed' if followed else 'backfill'].update({user['acct']: user for user in users})
+            entry['time'] = time.time()
+
+    def backfilled(self, access_token, acct):
+        with self._lock:
+            entry = self._entry(access_token)
+            entry['backfill'].pop(acct, None)
+            entry['followed'].pop(acct, None)
+
+    def take(self, access_token):
+        """Remove and return the context toot URLs, users and followed users left over for access_token"""
+        with self._lock:
+            entry = self._work.pop(xxhash.xxh64(access_token.encode('utf-8')).hexdigest(), None)
+        if entry is None:
+            return [], [], []
+        return list(entry['resolve']), list(entry['backfill'].values()), list(entry['followed'].values())
+
+    def load(self, entries):
+        now = time.time()
+        self._work = {
+            key: {
+                'resolve': dict.fromkeys(entry['resolve']),
+                'backfill': {user['acct']: user for user in entry['backfill']},
+                'followed': {user['acct']: user for user in entry.get('followed', [])},
+                'time': entry['time'],
+            }
+            for key, entry in entries.items()
+            if entry['time'] > now - self.MAX_AGE
+        }
+
+    def toJSON(self):
+        with self._lock:
+            return json.dumps({
+                key: {
+                    'resolve': list(entry['resolve']),
+                    'backfill': list(entry['backfill'].values()),
+                    'followed': list(entry['followed'].values()),
+                    'time': entry['time'],
+                }
+                for key, entry in self._work.items()
+                if entry['resolve'] or entry['backfill'] or entry['followed']
+            })
+
+
+PENDING_WORK = PendingWork()
+
+
+class Checkpoints:
+    """Calls save every `interval` minutes, and whenever asked to, on a background thread,
+    so that a checkpoint can be taken no matter what the rest of the run is doing.
+    When the run is terminated, the thread takes a last checkpoint and then calls on_terminate with the signal number"""
+
+    # a signal handler can't safely notify the thread, so it looks for a termination this often
+    POLL_INTERVAL = 1
+
+    def __init__(self, save, interval_minutes = 0, on_terminate = None):
+        self._save = save
+        self._on_terminate = on_terminate
+        self.interval = interval_minutes * 60
+        self.completed = 0
+        self.signum = None
+        self._requested = False
+        self._saving = False
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="FediFetcher-checkpoints", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def terminate(self, signum):
+        """Take a last checkpoint and exit. Only sets a flag, so that it is safe to call from a signal handler"""
+        self.signum = signum
+
+    def _wait(self):
+        due = time.monotonic() + self.interval if self.interval > 0 else None
+        while not (self._requested or self._stopped or self.signum is not None):
+            if due is not None and time.monotonic() >= due:
+                return
+            self._condition.wait(self.POLL_INTERVAL if due is None else min(self.POLL_INTERVAL, max(0, due - time.monotonic())))
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._wait()
+                if self._stopped:
+                    return
+                signum = self.signum
+                self._requested = False
+                self._saving = True
+            if signum is not None:
+                logger.warning(f"Received signal {signum}. Saving a checkpoint before exiting")
+            try:
+                self._save()
+                logger.debug("Saved a checkpoint")
+            except Exception as ex:
+                logger.error(f"Error saving a checkpoint. Exception: {ex}")
+            with self._condition:
+                self._saving = False
+                self.completed += 1
+                self._condition.notify_all()
+            if signum is not None and self._on_terminate is not None:
+                self._on_terminate(signum)
+                return
+
+    def save(self, timeout = None):
+        """Take a checkpoint now, and wait up to timeout seconds for it. Returns whether it was taken"""
+        with self._condition:
+            if self._stopped or not self._thread.is_alive():
+                return False
+            # a checkpoint that is already being saved may have missed recent changes
+            target = self.completed + (2 if self._saving else 1)
+            self._requested = True
+            self._condition.notify_all()
+            return self._condition.wait_for(lambda: self.completed >= target, timeout=timeout)
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._thread.is_alive():
+            self._thread.join()
+
+
+CHECKPOINTS = Checkpoints(None)
+
+
+def save_state(final = False):
+    """Save the state of the run to --state-dir: at its end, and for checkpoints during it"""
+    if arguments.state_db:
+        if final:
+            STATE_DB.close()
+        else:
+            STATE_DB.commit()
+    else:
+        known_followings.save()
+        seen_urls.save()
+
+        with open(REPLIED_TOOT_SERVER_IDS_FILE, "w", encoding="utf-8") as f:
+            json.dump(dict(list(replied_toot_server_ids.items())[-100000:]), f)
+
+        with open(RECENTLY_CHECKED_USERS_FILE, "w", encoding="utf-8") as f:
+            f.write(recently_checked_users.toJSON())
+
+        with open(SEEN_HOSTS_FILE, "w", encoding="utf-8") as f:
+            f.write(seen_hosts.toJSON())
+
+        with open(RECENTLY_CHECKED_CONTEXTS_FILE, "w", encoding="utf-8") as f:
+            # toots that haven't been fetched yet are left out, so that the next run fetches them
+            f.write(json.dumps({uri: toot for uri, toot in dict(recently_checked_context).items() if 'lastSeen' in toot}, default=str))
+
+        ROBOTS_STORE.save()
+
+    with open(RATE_LIMITS_FILE, "w", encoding="utf-8") as f:
+        f.write(RATE_LIMITER.toJSON())
+
+    with open(PENDING_WORK_FILE, "w", encoding="utf-8") as f:
+        f.write(PENDING_WORK.toJSON())
+
+    if arguments.seen_urls_history > 0:
+        seen_urls.save_filters()
+
+
+class Http2Session:
+    """An HTTP/2 client for a single host, which behaves like a requests.Session for the requests we make"""
+
+    def __init__(self, pool_size = 10):
+        self.requests_sent = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._client = httpx.Client(http2=True, limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size))
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    def request(self, method, url, headers = None, timeout = None, json = None, allow_redirects = True):
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        with self._lock:
+            self.requests_sent += 1
+        try:
+            response = self._client.request(method, url, headers=headers, timeout=timeout, json=json, follow_redirects=allow_redirects,
+                                            extensions={'trace': self._trace})
+        except httpx.ConnectTimeout as ex:
+            raise requests.exceptions.ConnectTimeout(str(ex)) from ex
+        except httpx.TimeoutException as ex:
+            raise requests.exceptions.ReadTimeout(str(ex)) from ex
+        except httpx.TransportError as ex:
+            raise requests.exceptions.ConnectionError(str(ex)) from ex
+
+        # hand the rest of FediFetcher the same response object it would get from requests
+        converted = requests.models.Response()
+        converted.status_code = response.status_code
+        converted.headers = requests.structures.CaseInsensitiveDict(response.headers.multi_items())
+        converted.url = str(response.url)
+        converted.encoding = response.encoding
+        converted._content = response.content
+        return converted
+
+    def _trace(self, event, info):
+        # httpcore tells us about every new connection it opens, whether it then speaks HTTP/2 or falls back to HTTP/1.1
+        if event in ('connection.connect_tcp.complete', 'connection.connect_unix_socket.complete'):
+            with self._lock:
+                self.connections += 1
+
+    def connection_counts(self):
+        with self._lock:
+            return self.connections, self.requests_sent
+
+    def close(self):
+        self._client.close()
+
+
+class SessionPool:
+    """Keeps one keep-alive session per host, so that repeated requests to the same host reuse their connections"""
+
+    def __init__(self, max_hosts = 100, pool_size = 10, http2_hosts = []):
+        self.max_hosts = max_hosts
+        self.pool_size = pool_size
+        self.http2_hosts = http2_hosts
+        self.hits = 0
+        self.misses = 0
+        self._sessions = OrderedDict()
+        self._retired = {'connections': 0, 'requests': 0}
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host in self._sessions:
+                self.hits += 1
+                self._sessions.move_to_end(host)
+                return self._sessions[host]
+
+            self.misses += 1
+            if httpx is not None and (host in self.http2_hosts or '*' in self.http2_hosts):
+                session = Http2Session(self.pool_size)
+            else:
+                session = http1_session(self.pool_size)
+            self._sessions[host] = session
+
+            if len(self._sessions) > self.max_hosts:
+                _, oldest = self._sessions.popitem(last=False)
+                self._retire(oldest)
+
+            return session
+
+    def _connection_counts(self, session):
+        if isinstance(session, Http2Session):
+            return session.connection_counts()
+        connections = 0
+        requests_sent = 0
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    connections += pool.num_connections
+                    requests_sent += pool.num_requests
+        return connections, requests_sent
+
+    def _retire(self, session):
+        connections, requests_sent = self._connection_counts(session)
+        self._retired['connections'] += connections
+        self._retired['requests'] += requests_sent
+        session.close()
+
+    def stats(self):
+        with self._lock:
+            connections = self._retired['connections']
+            requests_sent = self._retired['requests']
+            for session in self._sessions.values():
+                c, r = self._connection_counts(session)
+                connections += c
+                requests_sent += r
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'connections': connections,
+            'requests': requests_sent,
+            'reused': requests_sent - connections,
+        }
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                self._retire(session)
+            self._sessions.clear()
+
+
+HTTP_SESSIONS = SessionPool()
+
+
+def http1_session(pool_size = 10):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def benchmark_transports(url, headers, count, concurrency, timeout):
+    """Send the same workload over HTTP/1.1 and over HTTP/2, and return timings for both"""
+    results = {}
+    for transport, session in [('HTTP/1.1', http1_session(concurrency)), ('HTTP/2', Http2Session(concurrency))]:
+        def fetch(_):
+            sent = time.monotonic()
+            try:
+                status_code = session.get(url, headers=headers, timeout=timeout).status_code
+            except requests.exceptions.RequestException:
+                status_code = None
+            return time.monotonic() - sent, status_code
+
+        started = time.monotonic()
+        timings = run_concurrently(fetch, range(count), concurrency)
+        total = time.monotonic() - started
+        session.close()
+
+        latencies = sorted(latency for latency, _ in timings)
+        results[transport] = {
+            'total': total,
+            'mean': sum(latencies) / len(latencies),
+            'p95': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            'errors': len([status for _, status in timings if status != 200]),
+        }
+    return results
+
+
+class DnsCache:
+    """Caches successful DNS lookups in memory, so that we only look up each host once every `ttl` seconds.
+    The system resolver doesn't tell us record TTLs, so all entries share the same configured TTL."""
+
+    def __init__(self, ttl = 300):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._cache = {}
+        self._getaddrinfo = socket.getaddrinfo
+
+    def getaddrinfo(self, host, port, family = 0, type = 0, proto = 0, flags = 0):
+        key = (host, port, family, type, proto, flags)
+        entry = self._cache.get(key)
+        if entry is not None and entry[0] > time.time():
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        result = self._getaddrinfo(host, port, family, type, proto, flags)
+        self._cache[key] = (time.time() + self.ttl, result)
+        return result
+
+    def install(self):
+        """Route all lookups, including those made by urllib3 when opening connections, through the cache"""
+        socket.getaddrinfo = self.getaddrinfo
+
+    def uninstall(self):
+        socket.getaddrinfo = self._getaddrinfo
+
+    def prefetch(self, hosts, concurrency = 20):
+        """Look up the given hosts in the background, the same way urllib3 will look them up when connecting"""
+        def resolve(host):
+            try:
+                self.getaddrinfo(host, 443, allowed_gai_family(), socket.SOCK_STREAM)
+            except (OSError, UnicodeError):
+                pass
+
+        def resolve_all():
+            with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="FediFetcher-dns") as executor:
+                executor.map(resolve, hosts)
+            logger.debug(f"Pre-resolved {len(hosts)} known hosts")
+
+        thread = threading.Thread(target=resolve_all, name="FediFetcher-dns", daemon=True)
+        thread.start()
+        return thread
+
+
+def parse_cache_control(value):
+    directives = {}
+    for directive in value.split(','):
+        name, _, argument = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip('"')
+    return directives
+
+
+class ResponseCache:
+    """An on-disk cache of GET responses, which are revalidated using conditional requests once they go stale"""
+
+    KEEP_HEADERS = ['Content-Type', 'Link', 'ETag', 'Last-Modified', 'Cache-Control']
+
+    def __init__(self, directory = None, max_age_days = 0):
+        self.directory = directory
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.revalidated = 0
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, url):
+        return os.path.join(self.directory, f'{xxhash.xxh128(url.encode("utf-8")).hexdigest()}.json')
+
+    def lookup(self, url):
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(url), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get('url') != url:
+            return None
+        return entry
+
+    def is_fresh(self, entry):
+        return entry['expires'] > time.time()
+
+    def validators(self, entry):
+        headers = {}
+        if entry['headers'].get('ETag'):
+            headers['If-None-Match'] = entry['headers']['ETag']
+        if entry['headers'].get('Last-Modified'):
+            headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+        return headers
+
+    def serve(self, url, entry):
+        """Return a fresh entry as a response, without asking the server"""
+        self.hits += 1
+        return self._response(url, entry)
+
+    def _response(self, url, entry):
+        response = requests.models.Response()
+        response.status_code = 200
+        response.url = url
+        response.headers = requests.structures.CaseInsensitiveDict(entry['headers'])
+        response.encoding = 'utf-8'
+        response._content = entry['body'].encode('utf-8')
+        return response
+
+    def _expires(self, headers):
+        cache_control = parse_cache_control(headers.get('Cache-Control', ''))
+        if 'no-cache' in cache_control or 'max-age' not in cache_control:
+            return time.time()
+        try:
+            max_age = int(cache_control['max-age']) - int(headers.get('Age', 0))
+        except ValueError:
+            return time.time()
+        return time.time() + max(0, max_age)
+
+    def _write(self, url, entry):
+        path = self._path(url)
+        try:
+            with open(f"{path}.{threading.get_ident()}.tmp", "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            os.replace(f"{path}.{threading.get_ident()}.tmp", path)
+        except OSError as ex:
+            logger.warning(f"Could not write {url} to the HTTP cache: {ex}")
+
+    def store(self, url, response):
+        if self.directory is None:
+            return
+        if 'no-store' in parse_cache_control(response.headers.get('Cache-Control', '')):
+            return
+        headers = {name: response.headers[name] for name in self.KEEP_HEADERS if name in response.headers}
+        expires = self._expires(response.headers)
+        if 'ETag' not in headers and 'Last-Modified' not in headers and expires <= time.time():
+            # we would never be able to use this entry
+            return
+        self._write(url, {
+            'url': url,
+            'expires': expires,
+            'headers': headers,
+            'body': response.text,
+        })
+
+    def revalidate(self, url, entry, response):
+        """Refresh a cached entry after the server confirmed it with a 304, and return it as a response"""
+        self.revalidated += 1
+        for name in self.KEEP_HEADERS:
+            if name in response.headers and name != 'Content-Type':
+                entry['headers'][name] = response.headers[name]
+        entry['expires'] = self._expires(entry['headers'])
+        self._write(url, entry)
+        return self._response(url, entry)
+
+    def sweep(self):
+        """Remove entries we haven't refreshed in max_age_days. This runs at most once a day"""
+        if self.directory is None:
+            return
+        marker = os.path.join(self.directory, '.last_swept')
+        if os.path.exists(marker) and os.path.getmtime(marker) > time.time() - 60 * 60 * 24:
+            return
+        cut_off = time.time() - self.max_age_days * 24 * 60 * 60
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.json') and entry.stat().st_mtime < cut_off:
+                os.remove(entry.path)
+        with open(marker, "w", encoding="utf-8") as f:
+            f.write(f"{datetime.now()}")
+
+
+HTTP_CACHE = ResponseCache()
+
+
+class AdaptiveTimeouts:
+    """Derives per host read timeouts from the latencies we observed for that host: dead hosts fail fast,
+    while slow hosts that do respond get enough time to do so.
+    Timeouts are kept among the samples as None. After a timeout, the next request gets the maximum read timeout,
+    in case the host is just slow. Each further timeout in a row halves it, down to the minimum"""
+
+    SAMPLES = 20
+    MIN_SAMPLES = 5
+    MAX_HOSTS = 10000
+    FACTOR = 3
+
+    def __init__(self, latency = None, connect_timeout = 3, minimum = 2, maximum = 30, lock = None):
+        self.latency = latency if latency is not None else {}
+        self.connect_timeout = connect_timeout
+        self.minimum = minimum
+        self.maximum = maximum
+        self._lock = lock if lock is not None else threading.Lock()
+
+    def record(self, host, seconds):
+        with self._lock:
+            samples = self.latency.pop(host, [])
+            samples.append(None if seconds is None else round(seconds, 3))
+            self.latency[host] = samples[-self.SAMPLES:]
+            if len(self.latency) > self.MAX_HOSTS:
+                self.latency.pop(next(iter(self.latency)))
+
+    def record_timeout(self, host):
+        self.record(host, None)
+
+    def timeout(self, host, default):
+        """The (connect, read) timeouts for a request to host. Until we have enough responses, the read timeout is default"""
+        samples = self.latency.get(host, [])
+        latencies = sorted(sample for sample in samples if sample is not None)
+        if len(latencies) < self.MIN_SAMPLES:
+            read = default
+        else:
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            read = min(max(p99 * self.FACTOR, self.minimum), self.maximum)
+        timeouts = next((i for i, sample in enumerate(reversed(samples)) if sample is not None), len(samples))
+        if timeouts > 0:
+            # slow hosts get the time to respond once, while hosts that stopped responding soon fail fast
+            read = max(min(self.minimum, read), self.maximum / 2 ** (timeouts - 1))
+        return (min(self.connect_timeout, read), read)
+
+
+HOST_TIMEOUTS = AdaptiveTimeouts()
+
+
+class CircuitBreaker:
+    """Stops sending requests to hosts that keep timing out or failing.
+
+    A host's circuit opens after `threshold` consecutive failures, and stays open for the rest of the run.
+    Hosts that were open at the end of a previous run are half-open: we let a single request through,
+    which closes the circuit if it succeeds, and opens it again if it fails.
+    Exempt hosts, like our own server, are never skipped."""
+
+    def __init__(self, health = None, threshold = 5, forget_after_days = 30, exempt = (), lock = None):
+        self.health = health if health is not None else {}
+        self.threshold = threshold
+        self.exempt = set(exempt)
+        self.skipped = 0
+        self._probing = set()
+        self._lock = lock if lock is not None else threading.Lock()
+
+        cut_off = datetime.now() - timedelta(days=forget_after_days)
+        for host in list(self.health):
+            state = self.health[host]
+            if host in self.exempt or parser.parse(state['last_failure']) < cut_off:
+                self.health.pop(host)
+            elif state['state'] == 'open':
+                state['state'] = 'half-open'
+
+    def allow(self, host):
+        if self.threshold <= 0 or host in self.exempt:
+            return True
+        with self._lock:
+            state = self.health.get(host)
+            if state is None or state['state'] == 'closed':
+                return True
+            if state['state'] == 'half-open' and host not in self._probing:
+                self._probing.add(host)
+                logger.debug(f"Probing whether {host} has recovered")
+                return True
+            self.skipped += 1
+            return False
+
+    def record(self, host, success):
+        if self.threshold <= 0 or host in self.exempt:
+            return
+        with self._lock:
+            if success:
+                if self.health.pop(host, None) is not None:
+                    logger.info(f"{host} has recovered")
+                return
+
+            state = self.health.setdefault(host, {'state': 'closed', 'failures': 0})
+            state['failures'] += 1
+            state['last_failure'] = str(datetime.now())
+            if state['state'] == 'half-open' or (state['state'] == 'closed' and state['failures'] >= self.threshold):
+                state['state'] = 'open'
+                logger.warning(f"{host} failed {state['failures']} times in a row. Skipping it for the rest of this run")
+
+
+CIRCUIT_BREAKER = CircuitBreaker()
+
+
+class RunBudget:
+    """Keeps track of the time left before --max-runtime, so that the run can wind down gracefully"""
+
+    # We stop starting new work of each kind once less than this share of the run time is left.
+    # Backfills are the most expensive, and resolving context we already fetched the cheapest, so they go first and last.
+    WIND_DOWN = {
+        'backfill': 0.25,
+        'context': 0.15,
+        'resolve': 0.05,
+    }
+
+    def __init__(self, max_runtime_minutes = 0):
+        self.total = max_runtime_minutes * 60
+        self.deadline = time.time() + self.total if self.total > 0 else None
+        self.dropped = {kind: 0 for kind in self.WIND_DOWN}
+        self._lock = threading.Lock()
+
+    def remaining(self):
+        if self.deadline is None:
+            return None
+        return self.deadline - time.time()
+
+    def winding_down(self, kind):
+        """Whether we stopped starting work of the given kind"""
+        return self.deadline is not None and self.remaining() <= self.total * self.WIND_DOWN[kind]
+
+    def allows(self, kind):
+        """Whether there is still time to start work of the given kind"""
+        if not self.winding_down(kind):
+            return True
+        with self._lock:
+            if self.dropped[kind] == 0:
+                logger.warning(f"Approaching --max-runtime. Skipping any further {kind} work")
+            self.dropped[kind] += 1
+        return False
+
+    def timeout(self, timeout):
+        """Shrink a request timeout, or (connect, read) timeouts, so that the request can't run past the deadline"""
+        if self.deadline is None:
+            return timeout
+        if isinstance(timeout, tuple):
+            return tuple(self.timeout(t) for t in timeout)
+        return min(timeout, max(self.remaining(), 1))
+
+    def report(self):
+        if not any(self.dropped.values()):
+            return ""
+        return f"Skipped {self.dropped['backfill']} backfills, {self.dropped['context']} context fetches and {self.dropped['resolve']} context resolves to stay within --max-runtime."
+
+
+RUN_BUDGET = RunBudget()
+
+
+class HostRequestCap:
+    """Limits how many requests we send to any one host in a run"""
+
+    def __init__(self, cap = 0, exempt = ()):
+        self.cap = cap
+        self.exempt = set(exempt)
+        self.counts = {}
+        self.capped = set()
+        self._lock = threading.Lock()
+
+    def allows(self, host):
+        return self.cap <= 0 or host in self.exempt or self.counts.get(host, 0) < self.cap
+
+    def take(self, host):
+        """Count a request to host, if it is still within the cap"""
+        with self._lock:
+            if not self.allows(host):
+                if host not in self.capped:
+                    self.capped.add(host)
+                    logger.info(f"Reached --max-requests-per-host for {host}. Skipping any further requests to it in this run")
+                return False
+            self.counts[host] = self.counts.get(host, 0) + 1
+            return True
+
+
+HOST_REQUESTS = HostRequestCap()
 
-        raise Exception(f"Maximum number of retries exceeded for rate limited request {url}")
-    return response
 
 class ServerList:
+    HEALTH_KEY = '__health__'
+    LATENCY_KEY = '__latency__'
+
     def __init__(self, iterable):
         self._dict = {}
+        # per host health of the circuit breaker, and observed latencies, stored alongside the server info
+        self.health = iterable.pop(self.HEALTH_KEY, {})
+        self.latency = iterable.pop(self.LATENCY_KEY, {})
+        # the circuit breaker and the adaptive timeouts update health and latency from worker threads under this lock
+        self.lock = threading.Lock()
         for item in iterable:
             if('last_checked' in iterable[item]):
                 iterable[item]['last_checked'] = parser.parse(iterable[item]['last_checked'])
@@ -1212,8 +2867,23 @@ class ServerList:
     def __len__(self):
         return len(self._dict)
 
+    def items(self):
+        return self._dict.items()
+
+    def health_and_latency(self):
+        """Copies of health and latency that are safe to serialize while worker threads keep updating them"""
+        with self.lock:
+            return ({host: dict(state) for host, state in self.health.items()},
+                    {host: list(samples) for host, samples in self.latency.items()})
+
     def toJSON(self):
-        return json.dumps(self._dict,default=str)
+        data = dict(self._dict)
+        health, latency = self.health_and_latency()
+        if health:
+            data[self.HEALTH_KEY] = health
+        if latency:
+            data[self.LATENCY_KEY] = latency
+        return json.dumps(data,default=str)
 
 
 class OrderedSet:
@@ -1258,12 +2928,415 @@ class OrderedSet:
         return len(self._dict)
 
     def toJSON(self):
-        return json.dumps(self._dict,default=str)
+        return json.dumps(dict(self._dict),default=str)
+
+
+class JournaledOrderedSet(OrderedSet):
+    """An OrderedSet stored in a file with one item per line. New items are appended to the file as they are added,
+    and the file is only rewritten, with the newest `keep` items, once it grows past `compact_at` lines"""
+
+    def __init__(self, path, keep = 100000, compact_at = 150000):
+        lines = []
+        self._needs_newline = False
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                content = f.read()
+            lines = content.splitlines()
+            # files written by earlier versions don't end with a newline
+            self._needs_newline = content != "" and not content.endswith("\n")
+        super().__init__([])
+        for line in lines:
+            super().add(line)
+        self.path = path
+        self.keep = keep
+        self.compact_at = compact_at
+        self.lines = len(lines)
+        self._file = None
+        self._lock = threading.Lock()
+
+    def add(self, item, time = None):
+        with self._lock:
+            if item in self._dict:
+                return
+            super().add(item, time)
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+            if self._needs_newline:
+                self._file.write("\n")
+                self._needs_newline = False
+            self._file.write(f"{item}\n")
+            self.lines += 1
+
+    def save(self):
+        """Write any appended items to disk, and compact the file if it grew too large"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self.lines > self.compact_at:
+                items = list(self._dict)[-self.keep:]
+                with open(f"{self.path}.tmp", "w", encoding="utf-8") as f:
+                    f.write("".join(f"{item}\n" for item in items))
+                os.replace(f"{self.path}.tmp", self.path)
+                self.lines = len(items)
+                self._needs_newline = False
+
+
+class BloomFilter:
+    """A fixed size bit array that can tell for certain that an item was never added to it, and otherwise that it probably was.
+    Sized so that, with up to `capacity` items, items that weren't added are mistaken for added ones at `error_rate`"""
+
+    def __init__(self, capacity, error_rate = 0.001, bits = None, count = 0):
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2) // 8 * 8, 8)
+        self.hashes = max(round(self.size / capacity * math.log(2)), 1)
+        self.bits = bytearray(self.size // 8) if bits is None else bytearray(bits)
+        self.count = count
+
+    def _positions(self, item):
+        # double hashing: two independent 64 bit hashes stand in for `hashes` hash functions
+        digest = xxhash.xxh128_intdigest(item.encode('utf-8'))
+        first, second = digest >> 64, digest & 0xFFFFFFFFFFFFFFFF | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        positions = self._positions(item)
+        if all(self.bits[position >> 3] & (1 << (position & 7)) for position in positions):
+            return
+        for position in positions:
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class FilteredSet:
+    """A set with Bloom filters in front of it, which remember at least `capacity` items in a few bytes each, beyond what the set holds.
+
+    Items that dropped out of the set are still known to the filters. The set is checked too, as the filters can
+    be older than the set after an interrupted run, and can have rotated out items the set still holds.
+    Once the current filter holds `capacity` items it becomes the previous one, and a new one is started,
+    so memory use stays bounded"""
+
+    def __init__(self, items, capacity, error_rate = 0.001, path = None):
+        self.items = items
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.path = path
+        self._lock = threading.Lock()
+        self.current = BloomFilter(capacity, error_rate)
+        self.previous = BloomFilter(capacity, error_rate)
+        if not self._load():
+            for item in items:
+                self._remember(item)
+
+    def _load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return False
+        with open(self.path, "rb") as f:
+            header = json.loads(f.readline())
+            if header['capacity'] != self.capacity or header['error_rate'] != self.error_rate:
+                return False
+            filters = [BloomFilter(self.capacity, self.error_rate, f.read(self.current.size // 8), header[name]) for name in ['current', 'previous']]
+        if any(len(bloom_filter.bits) != self.current.size // 8 for bloom_filter in filters):
+            return False
+        self.current, self.previous = filters
+        return True
+
+    def save_filters(self):
+        with self._lock:
+            header = {'capacity': self.capacity, 'error_rate': self.error_rate, 'current': self.current.count, 'previous': self.previous.count}
+            with open(f"{self.path}.tmp", "wb") as f:
+                f.write(json.dumps(header).encode('utf-8') + b"\n")
+                f.write(self.current.bits)
+                f.write(self.previous.bits)
+            os.replace(f"{self.path}.tmp", self.path)
+
+    def _remember(self, item):
+        if self.current.count >= self.capacity:
+            self.previous = self.current
+            self.current = BloomFilter(self.capacity, self.error_rate)
+        self.current.add(item)
+
+    def add(self, item, time = None):
+        with self._lock:
+            self._remember(item)
+        self.items.add(item, time)
+
+    def update(self, iterable):
+        for item in iterable:
+            self.add(item)
+
+    def save(self):
+        self.items.save()
+
+    def __contains__(self, item):
+        return item in self.current or item in self.previous or item in self.items
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class StateDb:
+    """FediFetcher's state in a single SQLite database, as an alternative to the separate state files.
+    Lookups and changes only touch the rows involved, and all changes are committed when the database is closed"""
+
+    def __init__(self, path):
+        self.created = not os.path.exists(path)
+        self.collections = []
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self.execute("PRAGMA journal_mode=WAL")
+        self.execute("PRAGMA synchronous=NORMAL")
+        self.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def execute(self, sql, parameters = ()):
+        with self._lock:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    def executemany(self, sql, rows):
+        with self._lock:
+            self._connection.executemany(sql, rows)
+
+    def table(self, name, collection):
+        """Create the table for a collection, which is pruned when the database is closed"""
+        self.execute(f"CREATE TABLE IF NOT EXISTS {name} (key TEXT PRIMARY KEY, value TEXT, time REAL NOT NULL)")
+        self.execute(f"CREATE INDEX IF NOT EXISTS {name}_time ON {name} (time)")
+        self.collections.append(collection)
+
+    def get_meta(self, key, default = None):
+        rows = self.execute("SELECT value FROM meta WHERE key = ?", (key,))
+        return json.loads(rows[0][0]) if rows else default
+
+    def set_meta(self, key, value):
+        self.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value, default=str)))
+
+    def commit(self):
+        for collection in self.collections:
+            collection.prune()
+        with self._lock:
+            self._connection.commit()
+
+    def close(self):
+        self.commit()
+        with self._lock:
+            self._connection.close()
+
+
+class SqliteOrderedSet:
+    """An OrderedSet stored in a StateDb table. Items older than max_age seconds are treated as gone,
+    and only the newest `keep` items are kept when the database is closed"""
+
+    def __init__(self, db, name, max_age = None, keep = None):
+        self.db = db
+        self.name = name
+        self.max_age = max_age
+        self.keep = keep
+        db.table(name, self)
+
+    def _oldest(self):
+        return datetime.now().timestamp() - self.max_age if self.max_age is not None else 0
+
+    def add(self, item, time = None):
+        added = time.timestamp() if time is not None else datetime.now().timestamp()
+        self.db.execute(f"INSERT OR IGNORE INTO {self.name} (key, time) VALUES (?, ?)", (item, added))
+
+    def pop(self, item):
+        self.db.execute(f"DELETE FROM {self.name} WHERE key = ?", (item,))
+
+    def get(self, item):
+        rows = self.db.execute(f"SELECT time FROM {self.name} WHERE key = ? AND time >= ?", (item, self._oldest()))
+        if not rows:
+            raise KeyError(item)
+        return datetime.fromtimestamp(rows[0][0]).astimezone()
+
+    def update(self, iterable):
+        now = datetime.now().timestamp()
+        self.db.executemany(f"INSERT OR IGNORE INTO {self.name} (key, time) VALUES (?, ?)", ((item, now) for item in iterable))
+
+    def import_from(self, ordered_set):
+        self.db.executemany(f"INSERT OR IGNORE INTO {self.name} (key, time) VALUES (?, ?)", ((item, ordered_set.get(item).timestamp()) for item in ordered_set))
+
+    def __contains__(self, item):
+        return len(self.db.execute(f"SELECT 1 FROM {self.name} WHERE key = ? AND time >= ?", (item, self._oldest()))) > 0
+
+    def __iter__(self):
+        return iter([row[0] for row in self.db.execute(f"SELECT key FROM {self.name} WHERE time >= ? ORDER BY rowid", (self._oldest(),))])
+
+    def __len__(self):
+        return self.db.execute(f"SELECT COUNT(*) FROM {self.name} WHERE time >= ?", (self._oldest(),))[0][0]
+
+    def prune(self):
+        if self.max_age is not None:
+            self.db.execute(f"DELETE FROM {self.name} WHERE time < ?", (self._oldest(),))
+        if self.keep is not None:
+            self.db.execute(f"DELETE FROM {self.name} WHERE rowid <= (SELECT MAX(rowid) FROM {self.name}) - ?", (self.keep,))
+
+
+class SqliteDict:
+    """A dict of JSON serialisable values stored in a StateDb table.
+
+    Values are decoded with `decode` when read, and treated as gone if `expired` says so. Values that weren't written for
+    max_age seconds, and all but the `keep` most recently written, are removed when the database is closed.
+    As values are stored, changing a value that was read has to be followed by writing it back"""
+
+    _MISSING = object()
+
+    def __init__(self, db, name, decode = None, expired = None, max_age = None, keep = None):
+        self.db = db
+        self.name = name
+        self.decode = decode
+        self.expired = expired
+        self.max_age = max_age
+        self.keep = keep
+        db.table(name, self)
+
+    def _load(self, key):
+        rows = self.db.execute(f"SELECT value FROM {self.name} WHERE key = ?", (key,))
+        if not rows:
+            return self._MISSING
+        value = json.loads(rows[0][0])
+        if self.decode is not None:
+            value = self.decode(value)
+        if self.expired is not None and self.expired(value):
+            self.db.execute(f"DELETE FROM {self.name} WHERE key = ?", (key,))
+            return self._MISSING
+        return value
+
+    def __getitem__(self, key):
+        value = self._load(key)
+        if value is self._MISSING:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default = None):
+        value = self._load(key)
+        return default if value is self._MISSING else value
+
+    def __setitem__(self, key, value):
+        self.db.execute(f"INSERT OR REPLACE INTO {self.name} (key, value, time) VALUES (?, ?, ?)", (key, json.dumps(value, default=str), time.time()))
+
+    def pop(self, key, *default):
+        value = self._load(key)
+        if value is self._MISSING:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        self.db.execute(f"DELETE FROM {self.name} WHERE key = ?", (key,))
+        return value
+
+    def import_from(self, items):
+        now = time.time()
+        self.db.executemany(f"INSERT OR REPLACE INTO {self.name} (key, value, time) VALUES (?, ?, ?)", ((key, json.dumps(value, default=str), now) for key, value in items))
+
+    def __contains__(self, key):
+        return self._load(key) is not self._MISSING
+
+    def __iter__(self):
+        return iter([row[0] for row in self.db.execute(f"SELECT key FROM {self.name} ORDER BY rowid")])
+
+    def items(self):
+        for key, value in self.db.execute(f"SELECT key, value FROM {self.name} ORDER BY rowid"):
+            value = json.loads(value)
+            if self.decode is not None:
+                value = self.decode(value)
+            if self.expired is None or not self.expired(value):
+                yield key, value
+
+    def __len__(self):
+        return self.db.execute(f"SELECT COUNT(*) FROM {self.name}")[0][0]
+
+    def prune(self):
+        if self.max_age is not None:
+            self.db.execute(f"DELETE FROM {self.name} WHERE time < ?", (time.time() - self.max_age,))
+        if self.keep is not None:
+            self.db.execute(f"DELETE FROM {self.name} WHERE rowid <= (SELECT MAX(rowid) FROM {self.name}) - ?", (self.keep,))
+
+
+class SqliteServerList(SqliteDict):
+    """A ServerList stored in a StateDb table"""
+
+    def __init__(self, db, expired = None, max_age = None):
+        super().__init__(db, 'seen_hosts', decode_server_info, expired, max_age)
+        self.health = db.get_meta(ServerList.HEALTH_KEY, {})
+        self.latency = db.get_meta(ServerList.LATENCY_KEY, {})
+        self.lock = threading.Lock()
+
+    health_and_latency = ServerList.health_and_latency
+
+    def add(self, key, item):
+        self[key] = item
+
+    def get(self, key):
+        return self[key]
+
+    def import_from(self, server_list):
+        super().import_from((host, server_list.get(host)) for host in server_list)
+        self.health.update(server_list.health)
+        self.latency.update(server_list.latency)
+
+    def prune(self):
+        super().prune()
+        health, latency = self.health_and_latency()
+        self.db.set_meta(ServerList.HEALTH_KEY, health)
+        self.db.set_meta(ServerList.LATENCY_KEY, latency)
+
+
+class SetUnion:
+    """Whether an item is in any of the given sets, or was added to the union itself"""
+
+    def __init__(self, *sets):
+        self.sets = sets
+        self.added = set()
+
+    def add(self, item):
+        self.added.add(item)
+
+    def __contains__(self, item):
+        return item in self.added or any(item in s for s in self.sets)
+
+
+def decode_server_info(serverInfo):
+    if 'last_checked' in serverInfo:
+        serverInfo['last_checked'] = parser.parse(serverInfo['last_checked'])
+    return serverInfo
+
+def server_info_expired(serverInfo, remember_hosts_for_days):
+    if 'peertubeApiSupport' not in serverInfo and serverInfo.get('info', True) is not None:
+        # discovered by an older version, which didn't know about all APIs
+        return True
+    if 'last_checked' in serverInfo:
+        serverAge = datetime.now(serverInfo['last_checked'].tzinfo) - serverInfo['last_checked']
+        if(serverAge.total_seconds() > remember_hosts_for_days * 24 * 60 * 60 ):
+            return True
+        elif('info' in serverInfo and serverInfo['info'] == None and serverAge.total_seconds() > 60 * 60 ):
+            # Don't cache failures for more than 24 hours
+            return True
+    return False
+
+def decode_checked_context(toot):
+    for key in ['lastSeen', 'created_at']:
+        if isinstance(toot.get(key), str):
+            toot[key] = parser.parse(toot[key])
+    return toot
+
+def checked_context_expired(toot):
+    if 'lastSeen' not in toot:
+        return False
+    # dont really need to keep track for more than 7 days: if we haven't seen it in 7 days we can refetch content anyway
+    lastSeen = toot['lastSeen']
+    return (datetime.now(lastSeen.tzinfo) - lastSeen).total_seconds() > 7 * 24 * 60 * 60
+
 
 def get_server_from_host_meta(server):
     url = f'https://{server}/.well-known/host-meta'
     try:
-        resp = get(url, timeout = 30)
+        resp = get(url, timeout = 30, cache = True)
+    except RateLimitDeferred:
+        raise
     except Exception as ex:
         logger.error(f"Error getting host meta for {server}. Exception: {ex}")
         return None
@@ -1291,7 +3364,9 @@ def get_server_from_host_meta(server):
 def get_nodeinfo(server, seen_hosts, host_meta_fallback = False):
     url = f'https://{server}/.well-known/nodeinfo'
     try:
-        resp = get(url, timeout = 30)
+        resp = get(url, timeout = 30, cache = True)
+    except RateLimitDeferred:
+        raise
     except Exception as ex:
         logger.error(f"Error getting host node info for {server}. Exception: {ex}")
         return None
@@ -1348,7 +3423,9 @@ def get_nodeinfo(server, seen_hosts, host_meta_fallback = False):
         return seen_hosts.get(server)
 
     try:
-        resp = get(nodeLoc, timeout = 30)
+        resp = get(nodeLoc, timeout = 30, cache = True)
+    except RateLimitDeferred:
+        raise
     except Exception as ex:
         logger.error(f"Error getting host node info for {server}. Exception: {ex}")
         return None
@@ -1359,12 +3436,17 @@ def get_nodeinfo(server, seen_hosts, host_meta_fallback = False):
             if 'activitypub' not in nodeInfo['protocols']:
                 logger.warning(f'server {server} does not support activitypub, skipping')
                 return None
-            return {
+            serverInfo = {
                 'webserver': server,
                 'software': nodeInfo['software']['name'],
                 'version': nodeInfo['software']['version'],
                 'rawnodeinfo': nodeInfo,
             }
+            max_age = parse_cache_control(resp.headers.get('Cache-Control', '')).get('max-age')
+            if HTTP_CACHE.directory is not None and max_age is not None and max_age.isdigit():
+                # we revalidate it through the cache once this has passed, but no more than once an hour
+                serverInfo['max_age'] = max(int(max_age), 60 * 60)
+            return serverInfo
         except Exception as ex:
             logger.error(f'error getting server {server} info from nodeinfo. Exception: {ex}')
             return None
@@ -1372,11 +3454,35 @@ def get_nodeinfo(server, seen_hosts, host_meta_fallback = False):
         logger.error(f'Error getting host node info for {server}. Status Code: {resp.status_code}')
         return None
 
+def server_info_stale(serverInfo):
+    """Whether host info should be revalidated, as its nodeinfo's max-age has passed. This only applies with the response cache,
+    which turns the revalidation into conditional requests"""
+    if HTTP_CACHE.directory is None or 'max_age' not in serverInfo or 'last_checked' not in serverInfo:
+        return False
+    checked = max(serverInfo['last_checked'].timestamp(), serverInfo.get('revalidated', 0))
+    return time.time() - checked > serverInfo['max_age']
+
+def revalidate_server_info(server, serverInfo, seen_hosts):
+    """Refresh stale host info. If that fails, we keep using what we know"""
+    # an empty seen_hosts, so that get_nodeinfo() doesn't return the stale info
+    nodeinfo = get_nodeinfo(server, {})
+    if nodeinfo is None:
+        serverInfo['revalidated'] = time.time()
+        seen_hosts.add(server, serverInfo)
+        return serverInfo
+    set_server_apis(nodeinfo)
+    seen_hosts.add(server, nodeinfo)
+    if server != nodeinfo['webserver']:
+        seen_hosts.add(nodeinfo['webserver'], nodeinfo)
+    return nodeinfo
+
 def get_server_info(server, seen_hosts):
     if server in seen_hosts:
         serverInfo = seen_hosts.get(server)
         if('info' in serverInfo and serverInfo['info'] == None):
             return None
+        if server_info_stale(serverInfo):
+            return revalidate_server_info(server, serverInfo, seen_hosts)
         return serverInfo
 
     nodeinfo = get_nodeinfo(server, seen_hosts)
@@ -1392,6 +3498,26 @@ def get_server_info(server, seen_hosts):
             seen_hosts.add(nodeinfo['webserver'], nodeinfo)
     return nodeinfo
 
+def bootstrap_hosts(server, hosts, seen_hosts):
+    """Discover the robots.txt and server software of all the given hosts we haven't seen before, concurrently,
+    so that the work for them that follows doesn't have to do so one by one"""
+    if CONCURRENCY <= 1:
+        # nothing to gain over discovering them as we go
+        return
+
+    hosts = [host for host in dict.fromkeys(hosts) if host != server and host not in seen_hosts and host not in INSTANCE_BLOCKLIST and HOST_REQUESTS.allows(host)]
+    if len(hosts) == 0:
+        return
+
+    def discover(host):
+        # there's no point discovering servers we no longer have time to fetch anything from
+        if not RUN_BUDGET.winding_down('context'):
+            # getting the server info fetches its robots.txt first
+            get_server_info(host, seen_hosts)
+
+    logger.info(f"Discovering {len(hosts)} new servers")
+    run_concurrently(discover, hosts)
+
 def set_server_apis(server):
     # support for new server software should be added here
     software_apis = {
@@ -1522,7 +3648,9 @@ if __name__ == "__main__":
                 "on_fail",
                 "log_level",
                 "log_format",
-                "instance_blocklist"
+                "instance_blocklist",
+                "domain_blocks_file",
+                "http2_hosts"
             ]:
                 value = int(value)
             setattr(arguments, envvar, value)
@@ -1540,6 +3668,22 @@ if __name__ == "__main__":
     # in case someone provided the server name as url instead,
     setattr(arguments, 'server', re.sub(r"^(https://)?([^/]*)/?$", "\\2", arguments.server))
 
+    if arguments.benchmark_http2 > 0:
+        if httpx is None:
+            logger.critical("Benchmarking HTTP/2 requires the httpx[http2] package")
+            sys.exit(1)
+        token = arguments.access_token if isinstance(arguments.access_token, str) else arguments.access_token[0]
+        results = benchmark_transports(
+            f"https://{arguments.server}/api/v1/timelines/home?limit=40",
+            {"Authorization": f"Bearer {token}", "User-Agent": user_agent()},
+            arguments.benchmark_http2,
+            max(arguments.concurrency, 1),
+            (arguments.http_connect_timeout, arguments.http_timeout),
+        )
+        for transport, result in results.items():
+            logger.info(f"{transport}: {arguments.benchmark_http2} requests in {result['total']:.2f} sec, mean latency {result['mean'] * 1000:.0f} ms, p95 {result['p95'] * 1000:.0f} ms, {result['errors']} errors")
+        sys.exit(0)
+
 
     runId = uuid.uuid4()
 
@@ -1586,6 +3730,8 @@ if __name__ == "__main__":
     with open(LOCK_FILE, "w", encoding="utf-8") as f:
         f.write(f"{datetime.now()}")
 
+    RUN_BUDGET = RunBudget(arguments.max_runtime)
+
     try:
 
         SEEN_URLS_FILE = os.path.join(arguments.state_dir, "seen_urls")
@@ -1594,27 +3740,45 @@ if __name__ == "__main__":
         RECENTLY_CHECKED_USERS_FILE = os.path.join(arguments.state_dir, "recently_checked_users")
         SEEN_HOSTS_FILE = os.path.join(arguments.state_dir, "seen_hosts")
         RECENTLY_CHECKED_CONTEXTS_FILE = os.path.join(arguments.state_dir, 'recent_context')
-
-        INSTANCE_BLOCKLIST = [x.strip() for x in arguments.instance_blocklist.split(",")]
+        RATE_LIMITS_FILE = os.path.join(arguments.state_dir, 'rate_limits')
+        ROBOTS_FILE = os.path.join(arguments.state_dir, 'robots')
+        STATE_DB_FILE = os.path.join(arguments.state_dir, 'state.db')
+        PENDING_WORK_FILE = os.path.join(arguments.state_dir, 'pending_work')
+        SEEN_URLS_FILTER_FILE = os.path.join(arguments.state_dir, 'seen_urls_filter')
+
+        INSTANCE_BLOCKLIST = DomainBlocklist(arguments.instance_blocklist.split(","))
+        if arguments.domain_blocks_file:
+            for domain in read_domain_blocks_csv(arguments.domain_blocks_file):
+                INSTANCE_BLOCKLIST.add(domain, subdomains=True)
         ROBOTS_TXT = {}
-
-        seen_urls = OrderedSet([])
-        if os.path.exists(SEEN_URLS_FILE):
-            with open(SEEN_URLS_FILE, "r", encoding="utf-8") as f:
-                seen_urls = OrderedSet(f.read().splitlines())
+        HTTP2_HOSTS = [x.strip() for x in arguments.http2_hosts.split(",") if x.strip()]
+        if HTTP2_HOSTS and httpx is None:
+            logger.warning("--http2-hosts requires the httpx[http2] package. Falling back to HTTP/1.1")
+        HTTP_SESSIONS = SessionPool(arguments.http_pool_hosts, max(arguments.http_pool_size, arguments.concurrency, arguments.resolve_concurrency), HTTP2_HOSTS)
+        CONCURRENCY = arguments.concurrency
+        RESOLVE_POOL = WorkerPool(arguments.resolve_concurrency, "FediFetcher-resolve")
+        RESOLVE_LIMIT = AdaptiveConcurrency(arguments.resolve_concurrency, arguments.resolve_latency_target / 1000)
+        RETRY_POLICY = RetryPolicy(arguments.max_retries, arguments.retry_budget)
+        HOST_REQUESTS = HostRequestCap(arguments.max_requests_per_host, [arguments.server])
+        if arguments.http_cache_days > 0:
+            HTTP_CACHE = ResponseCache(os.path.join(arguments.state_dir, 'http_cache'), arguments.http_cache_days)
+            HTTP_CACHE.sweep()
+        RATE_LIMITER = HostRateLimiter(arguments.rate_limit_pacing)
+
+        # Once the state database exists, the state files are no longer used
+        read_state_files = not (arguments.state_db and os.path.exists(STATE_DB_FILE))
+
+        seen_urls = JournaledOrderedSet(SEEN_URLS_FILE) if read_state_files else OrderedSet([])
 
         replied_toot_server_ids = {}
-        if os.path.exists(REPLIED_TOOT_SERVER_IDS_FILE):
+        if read_state_files and os.path.exists(REPLIED_TOOT_SERVER_IDS_FILE):
             with open(REPLIED_TOOT_SERVER_IDS_FILE, "r", encoding="utf-8") as f:
                 replied_toot_server_ids = json.load(f)
 
-        known_followings = OrderedSet([])
-        if os.path.exists(KNOWN_FOLLOWINGS_FILE):
-            with open(KNOWN_FOLLOWINGS_FILE, "r", encoding="utf-8") as f:
-                known_followings = OrderedSet(f.read().splitlines())
+        known_followings = JournaledOrderedSet(KNOWN_FOLLOWINGS_FILE) if read_state_files else OrderedSet([])
 
         recently_checked_users = OrderedSet({})
-        if os.path.exists(RECENTLY_CHECKED_USERS_FILE):
+        if read_state_files and os.path.exists(RECENTLY_CHECKED_USERS_FILE):
             with open(RECENTLY_CHECKED_USERS_FILE, "r", encoding="utf-8") as f:
                 recently_checked_users = OrderedSet(json.load(f))
 
@@ -1626,12 +3790,15 @@ if __name__ == "__main__":
                 recently_checked_users.pop(user)
 
         recently_checked_context = {}
-        if(os.path.exists(RECENTLY_CHECKED_CONTEXTS_FILE)):
+        if(read_state_files and os.path.exists(RECENTLY_CHECKED_CONTEXTS_FILE)):
             with open(RECENTLY_CHECKED_CONTEXTS_FILE, "r", encoding="utf-8") as f:
                 recently_checked_context = json.load(f)
 
         # Remove any toots that we haven't seen in a while, to ensure this doesn't grow indefinitely
         for tootUrl in list(recently_checked_context):
+            if 'lastSeen' not in recently_checked_context[tootUrl]:
+                recently_checked_context.pop(tootUrl)
+                continue
             recently_checked_context[tootUrl]['lastSeen'] = parser.parse(recently_checked_context[tootUrl]['lastSeen'])
             recently_checked_context[tootUrl]['created_at'] = parser.parse(recently_checked_context[tootUrl]['created_at'])
             lastSeen = recently_checked_context[tootUrl]['lastSeen']
@@ -1640,11 +3807,17 @@ if __name__ == "__main__":
             if(userAge.total_seconds() > 7 * 24 * 60 * 60):
                 recently_checked_context.pop(tootUrl)
 
+        if os.path.exists(RATE_LIMITS_FILE):
+            with open(RATE_LIMITS_FILE, "r", encoding="utf-8") as f:
+                RATE_LIMITER.load(json.load(f))
+            if RATE_LIMITER.exhausted():
+                logger.info(f"Rate limits of {len(RATE_LIMITER.exhausted())} hosts haven't reset since the last run. Holding back requests to them until they do")
+
         parsed_urls = {}
 
         all_known_users = OrderedSet(list(known_followings) + list(recently_checked_users))
 
-        if os.path.exists(SEEN_HOSTS_FILE):
+        if read_state_files and os.path.exists(SEEN_HOSTS_FILE):
             with open(SEEN_HOSTS_FILE, "r", encoding="utf-8") as f:
                 seen_hosts = ServerList(json.load(f))
 
@@ -1662,20 +3835,107 @@ if __name__ == "__main__":
         else:
             seen_hosts = ServerList({})
 
-        # Delete any old robots.txt files so we can re-download them
-        for file_name in os.listdir(arguments.state_dir):
-            file_path = os.path.join(arguments.state_dir,file_name)
-            if file_name.startswith('robots-') and os.path.isfile(file_path):
-                if os.path.getmtime(file_path) < time.time() - 60 * 60 * 24:
+        if arguments.state_db:
+            STATE_DB = StateDb(STATE_DB_FILE)
+            db_seen_urls = SqliteOrderedSet(STATE_DB, 'seen_urls', keep=100000)
+            db_replied_toot_server_ids = SqliteDict(STATE_DB, 'replied_toot_server_ids', keep=100000)
+            db_known_followings = SqliteOrderedSet(STATE_DB, 'known_followings', keep=100000)
+            db_recently_checked_users = SqliteOrderedSet(STATE_DB, 'recently_checked_users', max_age=arguments.remember_users_for_hours * 60 * 60)
+            db_recently_checked_context = SqliteDict(STATE_DB, 'recent_context', decode_checked_context, checked_context_expired, max_age=7 * 24 * 60 * 60)
+            db_seen_hosts = SqliteServerList(STATE_DB, lambda serverInfo: server_info_expired(serverInfo, arguments.remember_hosts_for_days), arguments.remember_hosts_for_days * 24 * 60 * 60)
+
+            if STATE_DB.created:
+                logger.info(f"Importing state files into {STATE_DB_FILE}. The state files won't be used anymore, and can be deleted after this run")
+                db_seen_urls.import_from(seen_urls)
+                db_replied_toot_server_ids.import_from(replied_toot_server_ids.items())
+                db_known_followings.import_from(known_followings)
+                db_recently_checked_users.import_from(recently_checked_users)
+                db_recently_checked_context.import_from(recently_checked_context.items())
+                db_seen_hosts.import_from(seen_hosts)
+                STATE_DB.commit()
+
+            seen_urls = db_seen_urls
+            replied_toot_server_ids = db_replied_toot_server_ids
+            known_followings = db_known_followings
+            recently_checked_users = db_recently_checked_users
+            recently_checked_context = db_recently_checked_context
+            seen_hosts = db_seen_hosts
+            all_known_users = SetUnion(known_followings, recently_checked_users)
+
+        # Load the robots.txt files before sending any request that would otherwise download them again
+        robots_file_exists = os.path.exists(ROBOTS_FILE)
+        if arguments.state_db:
+            ROBOTS_STORE = RobotsStore(SqliteDict(STATE_DB, 'robots', max_age=RobotsStore.MAX_TTL))
+            if read_state_files and robots_file_exists:
+                ROBOTS_STORE.load(JournaledRobotsStore.read(ROBOTS_FILE))
+        else:
+            ROBOTS_STORE = JournaledRobotsStore(ROBOTS_FILE)
+        if read_state_files and not robots_file_exists:
+            # Earlier versions kept each robots.txt in its own file. They are only removed once, as we won't create any more
+            for file_name in os.listdir(arguments.state_dir):
+                file_path = os.path.join(arguments.state_dir,file_name)
+                if file_name.startswith('robots-') and file_name.endswith('.txt') and os.path.isfile(file_path):
                     logger.debug(f"Removing cached robots.txt file {file_name}")
                     os.remove(file_path)
 
+        if arguments.seen_urls_history > 0:
+            seen_urls = FilteredSet(seen_urls, arguments.seen_urls_history, path=SEEN_URLS_FILTER_FILE)
+
+        CIRCUIT_BREAKER = CircuitBreaker(seen_hosts.health, arguments.circuit_breaker_threshold, arguments.remember_hosts_for_days, [arguments.server], seen_hosts.lock)
+        HOST_TIMEOUTS = AdaptiveTimeouts(seen_hosts.latency, arguments.http_connect_timeout, min(2, arguments.http_timeout), arguments.http_max_timeout, seen_hosts.lock)
+
+        if arguments.domain_blocks_from_server > 0:
+            token = arguments.access_token if isinstance(arguments.access_token, str) else arguments.access_token[0]
+            for domain in get_server_domain_blocks(arguments.server, token, os.path.join(arguments.state_dir, 'domain_blocks'), arguments.domain_blocks_from_server):
+                INSTANCE_BLOCKLIST.add(domain, subdomains=True)
+        if len(INSTANCE_BLOCKLIST) > 0:
+            logger.info(f"Not connecting to {len(INSTANCE_BLOCKLIST)} blocked domains")
+
+        if arguments.dns_cache_ttl > 0:
+            DNS_CACHE = DnsCache(arguments.dns_cache_ttl)
+            DNS_CACHE.install()
+            known_hosts = {arguments.server}
+            for host, serverInfo in seen_hosts.items():
+                if serverInfo.get('info', True) is not None and host not in INSTANCE_BLOCKLIST:
+                    known_hosts.add(serverInfo.get('webserver', host))
+            DNS_CACHE.prefetch(list(known_hosts))
 
         if(isinstance(arguments.access_token, str)):
             setattr(arguments, 'access_token', [arguments.access_token])
 
+        if arguments.pool_access_tokens:
+            RESOLVE_TOKENS = TokenPool(arguments.access_token)
+
+        if os.path.exists(PENDING_WORK_FILE):
+            with open(PENDING_WORK_FILE, "r", encoding="utf-8") as f:
+                PENDING_WORK.load(json.load(f))
+
+        def exit_after_checkpoint(signum):
+            if os.path.exists(LOCK_FILE):
+                os.remove(LOCK_FILE)
+            logging.shutdown()
+            # the main thread can be anywhere in the run, so we leave without unwinding it
+            os._exit(128 + signum)
+
+        CHECKPOINTS = Checkpoints(save_state, arguments.checkpoint_interval, exit_after_checkpoint)
+        CHECKPOINTS.start()
+
+        def terminate(signum, frame):
+            # the main thread may be holding locks that saving needs, so the checkpoint thread saves and exits
+            CHECKPOINTS.terminate(signum)
+
+        signal.signal(signal.SIGTERM, terminate)
+
         for token in arguments.access_token:
 
+            urls, users, followed_users = PENDING_WORK.take(token)
+            if urls or users or followed_users:
+                """Carry on with the work an interrupted run left over"""
+                logger.info(f"Resuming {len(urls)} context toots and {len(users) + len(followed_users)} users left over from the previous run")
+                add_context_urls(arguments.server, token, urls, seen_urls)
+                add_user_posts(arguments.server, token, followed_users, known_followings, all_known_users, seen_urls, seen_hosts, followed=True)
+                add_user_posts(arguments.server, token, users, recently_checked_users, all_known_users, seen_urls, seen_hosts)
+
             if arguments.from_lists:
                 """Pull replies from lists"""
                 lists = get_user_lists(arguments.server, token)
@@ -1717,7 +3977,7 @@ if __name__ == "__main__":
                 logger.info(f"Getting posts from last {arguments.max_followings} followings")
                 user_id = get_user_id(arguments.server, arguments.user, token)
                 followings = get_new_followings(arguments.server, user_id, token, arguments.max_followings, all_known_users)
-                add_user_posts(arguments.server, token, followings, known_followings, all_known_users, seen_urls, seen_hosts)
+                add_user_posts(arguments.server, token, followings, known_followings, all_known_users, seen_urls, seen_hosts, followed=True)
 
             if arguments.max_followers > 0:
                 logger.info(f"Getting posts from last {arguments.max_followers} followers")
@@ -1747,28 +4007,29 @@ if __name__ == "__main__":
                 known_context_urls = get_all_known_context_urls(arguments.server, favourites,parsed_urls, seen_hosts)
                 add_context_urls(arguments.server, token, known_context_urls, seen_urls)
 
-        with open(KNOWN_FOLLOWINGS_FILE, "w", encoding="utf-8") as f:
-            f.write("\n".join(list(known_followings)[-100000:]))
-
-        with open(SEEN_URLS_FILE, "w", encoding="utf-8") as f:
-            f.write("\n".join(list(seen_urls)[-100000:]))
-
-        with open(REPLIED_TOOT_SERVER_IDS_FILE, "w", encoding="utf-8") as f:
-            json.dump(dict(list(replied_toot_server_ids.items())[-100000:]), f)
-
-        with open(RECENTLY_CHECKED_USERS_FILE, "w", encoding="utf-8") as f:
-            f.write(recently_checked_users.toJSON())
-
-        with open(SEEN_HOSTS_FILE, "w", encoding="utf-8") as f:
-            f.write(seen_hosts.toJSON())
-
-        with open(RECENTLY_CHECKED_CONTEXTS_FILE, "w", encoding="utf-8") as f:
-            f.write(json.dumps(recently_checked_context, default=str))
+        CHECKPOINTS.stop()
+        save_state(final=True)
 
+        RESOLVE_POOL.shutdown()
         os.remove(LOCK_FILE)
 
+        pool_stats = HTTP_SESSIONS.stats()
+        logger.info(f"Sent {pool_stats['requests']} requests over {pool_stats['connections']} connections ({pool_stats['reused']} reused). Session pool hits: {pool_stats['hits']}, misses: {pool_stats['misses']}")
+        if arguments.dns_cache_ttl > 0:
+            logger.info(f"DNS cache hits: {DNS_CACHE.hits}, misses: {DNS_CACHE.misses}")
+        if arguments.resolve_latency_target > 0:
+            logger.info(f"Finished with {RESOLVE_LIMIT.limit} concurrent requests to add context toots")
+        if IN_FLIGHT.shared > 0:
+            logger.info(f"Shared {IN_FLIGHT.shared} responses between identical concurrent requests")
+        if CIRCUIT_BREAKER.skipped > 0:
+            logger.info(f"Skipped {CIRCUIT_BREAKER.skipped} requests to failing servers")
+        if HTTP_CACHE.directory is not None:
+            logger.info(f"Served {HTTP_CACHE.hits} responses from the HTTP cache, and revalidated {HTTP_CACHE.revalidated}")
+
         duration = datetime.now() - start
         success_message = f"Processing finished in {duration}."
+        if RUN_BUDGET.report():
+            success_message = f"{success_message} {RUN_BUDGET.report()}"
 
         if(arguments.on_done != None and arguments.on_done != ''):
             try:
@@ -1779,6 +4040,8 @@ if __name__ == "__main__":
         logger.info(success_message)
 
     except Exception as ex:
+        # keep what we did get done, for the next run
+        CHECKPOINTS.save(timeout=20)
         os.remove(LOCK_FILE)
         duration = datetime.now() - start
         logger.error(f"Job failed after {duration}.")
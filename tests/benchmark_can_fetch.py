@@ -0,0 +1,50 @@
+"""Micro-benchmark for the robots.txt check that runs before every request.
+
+Compares parsing robots.txt for every request, as can_fetch() used to, with the cached
+rules can_fetch() uses now. Run from the repository root with:
+
+    python -m tests.benchmark_can_fetch
+"""
+import timeit
+import urllib.robotparser
+
+import find_posts
+
+ROBOTS_URL = "https://mastodon.example/robots.txt"
+USER_AGENT = "FediFetcher/benchmark"
+ROBOTS_TXT = """# See http://www.robotstxt.org/robotstxt.html for documentation on how to use the robots.txt file
+
+User-agent: GPTBot
+Disallow: /
+
+User-agent: *
+Disallow: /media_proxy/
+Disallow: /interact/
+Disallow: /api/v1/accounts/*/followers
+Disallow: /api/v1/accounts/*/following
+"""
+URLS = [f"https://mastodon.example/api/v1/statuses/{111000000000000000 + i}/context" for i in range(1000)]
+
+
+def parse_every_time(url):
+    robotParser = urllib.robotparser.RobotFileParser()
+    robotParser.parse(ROBOTS_TXT.splitlines())
+    robotParser.crawl_delay(USER_AGENT)
+    return robotParser.can_fetch(USER_AGENT, url)
+
+
+def cached(url):
+    return find_posts.can_fetch(USER_AGENT, url)
+
+
+def main():
+    find_posts.INSTANCE_BLOCKLIST = []
+    find_posts.ROBOTS_TXT = {ROBOTS_URL: ROBOTS_TXT}
+
+    for name, check in [("parse every time", parse_every_time), ("cached", cached)]:
+        seconds = min(timeit.repeat(lambda: [check(url) for url in URLS], number=10, repeat=5))
+        print(f"{name:>16}: {seconds / (10 * len(URLS)) * 1e6:8.2f} µs per request")
+
+
+if __name__ == "__main__":
+    main()
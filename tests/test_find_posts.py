@@ -1,5 +1,12 @@
+import http.server
 import json
+import os
 import re
+import socket
+import subprocess
+import sys
+import threading
+import time
 from datetime import datetime
 
 import find_posts
@@ -216,6 +223,34 @@ def test_add_post_with_context_post_not_added(mock_functions):
     assert result is False
 
 
+def test_add_post_with_context_stays_within_resolve_budget(mock_functions):
+    add_context_url, _, _, _ = mock_functions
+    pool = Mock(wraps=find_posts.WorkerPool(2))
+    budget = Mock()
+    budget.allows.return_value = False
+
+    with patch("find_posts.RESOLVE_POOL", pool), patch("find_posts.RUN_BUDGET", budget):
+        assert find_posts.add_post_with_context({"url": "http://example.com"}, "server", "access_token", set(), set()) is None
+
+    pool.map.assert_called_once()
+    budget.allows.assert_called_with("resolve")
+    add_context_url.assert_not_called()
+
+
+@patch("find_posts.get_user_posts", return_value=[{"url": "https://user1.com/post1"}])
+@patch("find_posts.add_post_with_context", return_value=None)
+def test_add_user_posts_leaves_skipped_users_pending(mock_add_post, mock_get_posts):
+    pending = find_posts.PendingWork()
+    known_followings = set()
+    user = {"acct": "user1", "url": "https://user1.com"}
+
+    with patch("find_posts.PENDING_WORK", pending):
+        add_user_posts("test_server", "token", [user], known_followings, set(), set(), {})
+
+    assert known_followings == set()
+    assert pending.take("token") == ([], [user], [])
+
+
 def test_user_has_opted_out():
     assert user_has_opted_out({"note": "I love robots"}) == False
     assert user_has_opted_out({"note": "I love robots, nobot"}) == True
@@ -1085,44 +1120,44 @@ def test_parse_peertube_profile_url_none():
         parse_peertube_profile_url(None)
 
 
-@patch("find_posts.requests")
+@patch("find_posts.HTTP_SESSIONS")
 @patch("find_posts.logger")
-def test_get_redirect_url_success(mock_logger, mock_requests):
+def test_get_redirect_url_success(mock_logger, mock_sessions):
     response = Response()
     response.status_code = 200
-    mock_requests.head.return_value = response
+    mock_sessions.get.return_value.head.return_value = response
     assert find_posts.get_redirect_url("https://test.com") == "https://test.com"
     mock_logger.error.assert_not_called()
     mock_logger.debug.assert_not_called()
 
 
-@patch("find_posts.requests")
+@patch("find_posts.HTTP_SESSIONS")
 @patch("find_posts.logger")
-def test_get_redirect_url_redirected(mock_logger, mock_requests):
+def test_get_redirect_url_redirected(mock_logger, mock_sessions):
     response = Response()
     response.status_code = 302
     response.headers = {"Location": "https://redirected.com"}
-    mock_requests.head.return_value = response
+    mock_sessions.get.return_value.head.return_value = response
     assert find_posts.get_redirect_url("https://test.com") == "https://redirected.com"
     mock_logger.error.assert_not_called()
     mock_logger.debug.assert_called_once()
 
 
-@patch("find_posts.requests")
+@patch("find_posts.HTTP_SESSIONS")
 @patch("find_posts.logger")
-def test_get_redirect_url_error_status_code(mock_logger, mock_requests):
+def test_get_redirect_url_error_status_code(mock_logger, mock_sessions):
     response = Response()
     response.status_code = 500
-    mock_requests.head.return_value = response
+    mock_sessions.get.return_value.head.return_value = response
     assert find_posts.get_redirect_url("https://test.com") is None
     mock_logger.error.assert_called_once()
     mock_logger.debug.assert_not_called()
 
 
-@patch("find_posts.requests")
+@patch("find_posts.HTTP_SESSIONS")
 @patch("find_posts.logger")
-def test_get_redirect_url_exception(mock_logger, mock_requests):
-    mock_requests.head.side_effect = requests.exceptions.RequestException
+def test_get_redirect_url_exception(mock_logger, mock_sessions):
+    mock_sessions.get.return_value.head.side_effect = requests.exceptions.RequestException
     assert find_posts.get_redirect_url("https://test.com") is None
     mock_logger.error.assert_called_once()
     mock_logger.debug.assert_not_called()
@@ -1447,8 +1482,8 @@ def test_get_cached_robots_cached():
     assert find_posts.get_cached_robots("test_url") == "test_robots_txt"
 
 
-@patch("find_posts.get_robots_txt_cache_path", return_value="test_cache_path")
-def test_get_cached_robots_no_cache(mock_get_path):
+@patch("find_posts.ROBOTS_STORE", find_posts.RobotsStore())
+def test_get_cached_robots_no_cache():
     find_posts.ROBOTS_TXT = {}
     assert find_posts.get_cached_robots("test_url") is None
 
@@ -1523,31 +1558,33 @@ def test_robots_txt_prohibited(mock_requests, headers, url):
         mock_can_fetch.assert_called_once_with(headers["User-Agent"], url)
 
 
-@patch("find_posts.requests")
+@patch("find_posts.HTTP_SESSIONS")
 @patch("find_posts.can_fetch")
 @patch("find_posts.user_agent")
 @patch("find_posts.logger")
-def test_post_success(mock_logger, mock_user_agent, mock_can_fetch, mock_requests):
+def test_post_success(mock_logger, mock_user_agent, mock_can_fetch, mock_sessions):
     url = "http://testurl.com"
     mock_json = {"key": "value"}
     headers = {"User-Agent": "test_agent"}
     timeout = 2
     mock_user_agent.return_value = "test_agent"
     mock_can_fetch.return_value = True
-    mock_requests.post.return_value.status_code = 200
+    mock_sessions.get.return_value.post.return_value.status_code = 200
+    mock_sessions.get.return_value.post.return_value.headers = {}
 
     post(url, mock_json, headers, timeout)
 
-    mock_requests.post.assert_called_once_with(
-        url, json=mock_json, headers=headers, timeout=timeout
+    mock_sessions.get.assert_called_once_with(url)
+    mock_sessions.get.return_value.post.assert_called_once_with(
+        url, json=mock_json, headers=headers, timeout=(timeout, timeout)
     )
 
 
-@patch("find_posts.requests")
+@patch("find_posts.HTTP_SESSIONS")
 @patch("find_posts.can_fetch")
 @patch("find_posts.user_agent")
 @patch("find_posts.logger")
-def test_post_rate_limit(mock_logger, mock_user_agent, mock_can_fetch, mock_requests):
+def test_post_rate_limit(mock_logger, mock_user_agent, mock_can_fetch, mock_sessions):
     url = "http://testurl.com"
     mock_json = {"key": "value"}
     headers = {"User-Agent": "test_agent"}
@@ -1557,7 +1594,7 @@ def test_post_rate_limit(mock_logger, mock_user_agent, mock_can_fetch, mock_requ
     response = Mock()
     response.status_code = 429
     response.headers = {"x-ratelimit-reset": "1900-01-01 01:00:00"}
-    mock_requests.post.return_value = response
+    mock_sessions.get.return_value.post.return_value = response
 
     with pytest.raises(Exception):
         post(url, mock_json, headers, timeout)
@@ -1595,7 +1632,7 @@ def test_get_server_from_host_meta(mock_logger, mock_parse, mock_get):
     mock_parse.return_value.find.return_value.get.return_value = f"https://{result}/"
     assert find_posts.get_server_from_host_meta(server) == result
     mock_get.assert_called_once_with(
-        f"https://{server}/.well-known/host-meta", timeout=30
+        f"https://{server}/.well-known/host-meta", timeout=30, cache=True
     )
     mock_parse.assert_called_once_with(mock_response.text)
     mock_logger.error.assert_not_called()
@@ -1666,6 +1703,47 @@ def test_get_nodeinfo_404_status(mock_logger, mock_get):
     assert response is None
 
 
+@patch("find_posts.get")
+def test_get_nodeinfo_records_max_age_with_cache(mock_get, tmp_path):
+    well_known = make_response(200, {}, json.dumps({"links": [{"rel": "http://nodeinfo.diaspora.software/ns/schema/2.0", "href": "https://test.server/nodeinfo/2.0"}]}))
+    nodeinfo = make_response(200, {"Cache-Control": "max-age=1800, public"}, json.dumps({"protocols": ["activitypub"], "software": {"name": "mastodon", "version": "4.3.0"}}))
+
+    mock_get.side_effect = [well_known, nodeinfo]
+    assert "max_age" not in find_posts.get_nodeinfo("test.server", {})
+
+    mock_get.side_effect = [well_known, nodeinfo]
+    with patch("find_posts.HTTP_CACHE", find_posts.ResponseCache(str(tmp_path))):
+        serverInfo = find_posts.get_nodeinfo("test.server", {})
+    # no more than once an hour
+    assert serverInfo["max_age"] == 60 * 60
+
+
+@patch("find_posts.get_nodeinfo")
+def test_get_server_info_revalidates_stale_info_with_cache(mock_get_nodeinfo, tmp_path):
+    stale = {"webserver": "test.server", "software": "mastodon", "rawnodeinfo": {}, "peertubeApiSupport": False,
+             "max_age": 60 * 60, "last_checked": datetime.now() - find_posts.timedelta(hours=2)}
+    seen_hosts = find_posts.ServerList({})
+    seen_hosts.add("test.server", dict(stale))
+
+    # without the cache, host info is kept for --remember-hosts-for-days
+    assert not find_posts.server_info_expired(stale, 30)
+    assert find_posts.get_server_info("test.server", seen_hosts)["software"] == "mastodon"
+    mock_get_nodeinfo.assert_not_called()
+
+    with patch("find_posts.HTTP_CACHE", find_posts.ResponseCache(str(tmp_path))):
+        # if revalidating fails, we keep what we know, and don't try again right away
+        mock_get_nodeinfo.return_value = None
+        assert find_posts.get_server_info("test.server", seen_hosts)["software"] == "mastodon"
+        assert find_posts.get_server_info("test.server", seen_hosts)["software"] == "mastodon"
+        assert mock_get_nodeinfo.call_count == 1
+
+        seen_hosts.add("test.server", dict(stale))
+        mock_get_nodeinfo.return_value = {"webserver": "test.server", "software": "pleroma", "version": "2.7", "rawnodeinfo": {}}
+        assert find_posts.get_server_info("test.server", seen_hosts)["software"] == "pleroma"
+        assert seen_hosts.get("test.server")["software"] == "pleroma"
+        mock_get_nodeinfo.assert_called_with("test.server", {})
+
+
 def test_set_server_apis():
     # mock server data
     server = {
@@ -1842,3 +1920,1343 @@ def test_fetch_timeline_context_with_empty_posts(
     )
     assert not mock_filter_known_users.called
     assert not mock_add_user_posts.called
+
+
+def test_session_pool_reuses_session_per_host():
+    pool = find_posts.SessionPool(max_hosts=2, pool_size=4)
+
+    first = pool.get("https://a.example/api/v1/statuses/1/context")
+    assert pool.get("https://a.example/.well-known/nodeinfo") is first
+    assert pool.get("https://b.example/robots.txt") is not first
+
+    stats = pool.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+    assert first.get_adapter("https://a.example/").poolmanager.connection_pool_kw["maxsize"] == 4
+
+
+def test_session_pool_evicts_least_recently_used_host():
+    pool = find_posts.SessionPool(max_hosts=2)
+
+    a = pool.get("https://a.example/")
+    pool.get("https://b.example/")
+    pool.get("https://a.example/")
+    pool.get("https://c.example/")
+
+    assert pool.get("https://a.example/") is a
+    assert pool.stats()["misses"] == 3
+    pool.get("https://b.example/")
+    assert pool.stats()["misses"] == 4
+
+
+def test_run_concurrently_keeps_result_order():
+    def slow_square(n):
+        time.sleep(0.01 * (5 - n))
+        return n * n
+
+    assert find_posts.run_concurrently(slow_square, range(5), concurrency=5) == [0, 1, 4, 9, 16]
+    assert find_posts.run_concurrently(slow_square, range(5), concurrency=1) == [0, 1, 4, 9, 16]
+
+
+def test_run_concurrently_limits_concurrency():
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def work(item):
+        with lock:
+            running.append(item)
+            peak.append(len(running))
+        time.sleep(0.02)
+        with lock:
+            running.remove(item)
+        # nested work runs inline inside a worker
+        return find_posts.run_concurrently(lambda x: threading.current_thread().name, [1, 2], concurrency=4)
+
+    results = find_posts.run_concurrently(work, range(8), concurrency=3)
+
+    assert max(peak) == 3
+    for names in results:
+        assert names[0] == names[1]
+
+
+def test_rate_limiter_paces_when_budget_runs_low():
+    limiter = find_posts.HostRateLimiter(pacing=50)
+    key = ("big.example", None)
+    reset = time.time() + 100
+
+    limiter.update(key, {"x-ratelimit-limit": "300", "x-ratelimit-remaining": "200", "x-ratelimit-reset": str(reset)})
+    assert limiter.delay(key) == 0
+    assert limiter.delay(key) == 0
+
+    limiter.update(key, {"x-ratelimit-limit": "300", "x-ratelimit-remaining": "10", "x-ratelimit-reset": str(reset)})
+    assert limiter.delay(key) == 0
+    # the remaining 10 requests are spread over the 100 seconds left in the window
+    assert 9 < limiter.delay(key) <= 10
+
+
+def test_rate_limiter_waits_for_reset_when_exhausted():
+    limiter = find_posts.HostRateLimiter()
+    key = ("big.example", "token")
+    reset = datetime.now().astimezone() + find_posts.timedelta(seconds=30)
+
+    limiter.update(key, {"x-ratelimit-limit": "300", "x-ratelimit-remaining": "0", "x-ratelimit-reset": reset.isoformat()})
+    assert 29 < limiter.delay(key) <= 30
+    assert limiter.delay(("big.example", "other-token")) == 0
+
+
+def test_rate_limiter_respects_crawl_delay():
+    limiter = find_posts.HostRateLimiter()
+    limiter.set_crawl_delay("slow.example", 2)
+    key = ("slow.example", None)
+
+    assert limiter.delay(key) == 0
+    assert 1.9 < limiter.delay(key) <= 2
+
+
+def test_rate_limiter_gives_back_deferred_slots():
+    limiter = find_posts.HostRateLimiter()
+    limiter.set_crawl_delay("slow.example", 30)
+    key = ("slow.example", None)
+    limiter.update(key, {"x-ratelimit-limit": "300", "x-ratelimit-remaining": "200", "x-ratelimit-reset": str(time.time() + 100)})
+    assert limiter.delay(key) == 0
+
+    with patch("find_posts.DEFER_THRESHOLD", 0.1):
+        result, deferred_until = find_posts.run_deferrable(limiter.wait, key)
+    assert deferred_until is not None
+
+    # the deferred request neither used up the budget nor pushed back the requests after it
+    assert limiter.budget(key)["remaining"] == 199
+    assert 29 < limiter.delay(key) <= 30
+
+
+@patch("find_posts.logger")
+def test_add_context_urls_uses_resolve_pool(mock_logger):
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def resolve(url, server, access_token):
+        with lock:
+            running.append(url)
+            peak.append(len(running))
+        time.sleep(0.02)
+        with lock:
+            running.remove(url)
+        return url != "url3"
+
+    seen_urls = {"url1"}
+    with patch("find_posts.add_context_url", side_effect=resolve) as mock_add_context_url, \
+            patch("find_posts.RESOLVE_POOL", find_posts.WorkerPool(2)):
+        add_context_urls("test_server", "test_token", ["url1", "url2", "url3", "url4", "url5", "url2"], seen_urls)
+
+    assert mock_add_context_url.call_count == 4
+    assert max(peak) == 2
+    assert seen_urls == {"url1", "url2", "url4", "url5"}
+    assert mock_logger.info.call_args[0][0] == "Added 3 new context toots (with 1 failures)"
+
+
+def make_response(status_code, headers=None, body=""):
+    response = Response()
+    response.status_code = status_code
+    response.headers = requests.structures.CaseInsensitiveDict(headers or {})
+    response._content = body.encode("utf-8")
+    response.encoding = "utf-8"
+    return response
+
+
+@patch("find_posts.HTTP_SESSIONS")
+@patch("find_posts.can_fetch", return_value=True)
+def test_get_serves_fresh_responses_from_cache(mock_can_fetch, mock_sessions, tmp_path):
+    url = "https://remote.example/.well-known/nodeinfo"
+    mock_sessions.get.return_value.get.return_value = make_response(
+        200, {"Cache-Control": "max-age=3600", "Content-Type": "application/json"}, '{"links": []}'
+    )
+
+    with patch("find_posts.HTTP_CACHE", find_posts.ResponseCache(str(tmp_path), 7)):
+        assert get(url, {"User-Agent": "test"}, timeout=5, cache=True).json() == {"links": []}
+        cached = get(url, {"User-Agent": "test"}, timeout=5, cache=True)
+
+    assert cached.json() == {"links": []}
+    assert cached.headers["Content-Type"] == "application/json"
+    assert mock_sessions.get.return_value.get.call_count == 1
+
+
+@patch("find_posts.HTTP_SESSIONS")
+@patch("find_posts.can_fetch", return_value=True)
+def test_get_revalidates_stale_responses(mock_can_fetch, mock_sessions, tmp_path):
+    url = "https://remote.example/api/v1/statuses/1/context"
+    session = mock_sessions.get.return_value
+    session.get.return_value = make_response(
+        200, {"ETag": 'W/"abc"', "Cache-Control": "max-age=0, public"}, '{"ancestors": [], "descendants": []}'
+    )
+
+    with patch("find_posts.HTTP_CACHE", find_posts.ResponseCache(str(tmp_path), 7)) as cache:
+        get(url, {"User-Agent": "test"}, timeout=5, cache=True)
+        session.get.return_value = make_response(304, {"ETag": 'W/"abc"'})
+        response = get(url, {"User-Agent": "test"}, timeout=5, cache=True)
+        assert cache.revalidated == 1
+
+    assert response.status_code == 200
+    assert response.json() == {"ancestors": [], "descendants": []}
+    assert session.get.call_args[1]["headers"]["If-None-Match"] == 'W/"abc"'
+
+
+@patch("find_posts.HTTP_SESSIONS")
+@patch("find_posts.can_fetch", return_value=True)
+def test_get_does_not_cache_authenticated_requests(mock_can_fetch, mock_sessions, tmp_path):
+    url = "https://my.server/api/v1/timelines/home"
+    mock_sessions.get.return_value.get.return_value = make_response(200, {"Cache-Control": "max-age=3600"}, "[]")
+
+    with patch("find_posts.HTTP_CACHE", find_posts.ResponseCache(str(tmp_path), 7)):
+        get(url, {"User-Agent": "test", "Authorization": "Bearer token"}, timeout=5, cache=True)
+        get(url, {"User-Agent": "test", "Authorization": "Bearer token"}, timeout=5, cache=True)
+
+    assert mock_sessions.get.return_value.get.call_count == 2
+
+
+def test_circuit_breaker_opens_after_consecutive_failures():
+    breaker = find_posts.CircuitBreaker(threshold=3)
+
+    breaker.record("dead.example", False)
+    breaker.record("dead.example", False)
+    breaker.record("dead.example", True)
+    breaker.record("dead.example", False)
+    breaker.record("dead.example", False)
+    assert breaker.allow("dead.example")
+
+    breaker.record("dead.example", False)
+    assert not breaker.allow("dead.example")
+    assert breaker.allow("alive.example")
+    assert breaker.skipped == 1
+
+
+def test_circuit_breaker_half_opens_on_next_run():
+    health = {}
+    breaker = find_posts.CircuitBreaker(health, threshold=1)
+    breaker.record("dead.example", False)
+
+    seen_hosts = find_posts.ServerList({"dead.example": {}})
+    seen_hosts.health = health
+    saved = json.loads(seen_hosts.toJSON())
+
+    next_run = find_posts.CircuitBreaker(find_posts.ServerList(saved).health, threshold=1)
+    assert next_run.allow("dead.example")
+    assert not next_run.allow("dead.example")
+
+    next_run.record("dead.example", True)
+    assert next_run.allow("dead.example")
+    assert "dead.example" not in next_run.health
+
+
+def test_circuit_breaker_never_skips_exempt_hosts():
+    health = {"my.server": {"state": "open", "failures": 5, "last_failure": str(datetime.now())}}
+    breaker = find_posts.CircuitBreaker(health, threshold=1, exempt=["my.server"])
+    assert "my.server" not in health
+
+    breaker.record("my.server", False)
+    breaker.record("my.server", False)
+    assert breaker.allow("my.server")
+    assert breaker.skipped == 0
+
+
+def test_server_list_without_health_keeps_file_format():
+    seen_hosts = find_posts.ServerList({})
+    seen_hosts.add("host.example", {"software": "mastodon"})
+    assert json.loads(seen_hosts.toJSON()) == {"host.example": {"software": "mastodon"}}
+
+
+@patch("find_posts.HTTP_SESSIONS")
+@patch("find_posts.can_fetch", return_value=True)
+def test_get_skips_hosts_with_open_circuit(mock_can_fetch, mock_sessions):
+    mock_sessions.get.return_value.get.side_effect = requests.exceptions.ConnectTimeout
+
+    with patch("find_posts.CIRCUIT_BREAKER", find_posts.CircuitBreaker(threshold=2)), \
+            patch("find_posts.RETRY_POLICY", find_posts.RetryPolicy(max_retries=0)):
+        for _ in range(2):
+            with pytest.raises(requests.exceptions.ConnectTimeout):
+                get("https://dead.example/api/v1/statuses/1/context", {"User-Agent": "test"}, timeout=5)
+        with pytest.raises(Exception, match="failing repeatedly"):
+            get("https://dead.example/api/v1/statuses/2/context", {"User-Agent": "test"}, timeout=5)
+
+    assert mock_sessions.get.return_value.get.call_count == 2
+
+
+def test_run_budget_winds_down_in_order():
+    budget = find_posts.RunBudget(10)
+    assert budget.allows("backfill")
+
+    budget.deadline = time.time() + 60  # 10% of the run time left
+    assert not budget.allows("backfill")
+    assert not budget.allows("context")
+    assert budget.allows("resolve")
+    assert budget.dropped == {"backfill": 1, "context": 1, "resolve": 0}
+    assert "Skipped 1 backfills, 1 context fetches and 0 context resolves" in budget.report()
+
+
+def test_run_budget_shrinks_timeouts():
+    assert find_posts.RunBudget(0).timeout(30) == 30
+
+    budget = find_posts.RunBudget(10)
+    budget.deadline = time.time() + 10
+    assert 9 < budget.timeout(30) <= 10
+    assert budget.timeout(5) == 5
+    budget.deadline = time.time() - 10
+    assert budget.timeout(5) == 1
+
+
+@patch("find_posts.add_context_url", return_value=True)
+@patch("find_posts.logger")
+def test_add_context_urls_skips_resolves_past_deadline(mock_logger, mock_add_context_url):
+    budget = find_posts.RunBudget(10)
+    budget.deadline = time.time()
+    seen_urls = set()
+
+    with patch("find_posts.RUN_BUDGET", budget):
+        add_context_urls("test_server", "test_token", ["url1", "url2"], seen_urls)
+
+    mock_add_context_url.assert_not_called()
+    assert seen_urls == set()
+    assert budget.dropped["resolve"] == 2
+    mock_logger.info.assert_any_call("Added 0 new context toots (with 0 failures)")
+
+
+@patch("find_posts.time.sleep")
+@patch("find_posts.HTTP_SESSIONS")
+@patch("find_posts.can_fetch", return_value=True)
+def test_get_retries_timeouts_and_server_errors(mock_can_fetch, mock_sessions, mock_sleep):
+    session = mock_sessions.get.return_value
+    session.get.side_effect = [
+        requests.exceptions.ReadTimeout(),
+        make_response(502),
+        make_response(200, body="{}"),
+    ]
+
+    with patch("find_posts.RETRY_POLICY", find_posts.RetryPolicy(max_retries=2)) as policy:
+        response = get("https://flaky.example/api/v1/statuses/1/context", {"User-Agent": "test"}, timeout=5)
+
+    assert response.status_code == 200
+    assert session.get.call_count == 3
+    assert policy.retries == 2
+    # capped, jittered exponential backoff
+    assert 0.25 <= mock_sleep.call_args_list[0][0][0] <= 0.5
+    assert 0.5 <= mock_sleep.call_args_list[1][0][0] <= 1
+
+
+@patch("find_posts.time.sleep")
+@patch("find_posts.HTTP_SESSIONS")
+@patch("find_posts.can_fetch", return_value=True)
+def test_get_honours_retry_after(mock_can_fetch, mock_sessions, mock_sleep):
+    session = mock_sessions.get.return_value
+    session.get.side_effect = [make_response(503, {"Retry-After": "3"}), make_response(200)]
+
+    with patch("find_posts.RETRY_POLICY", find_posts.RetryPolicy(max_retries=2)):
+        assert get("https://busy.example/", {"User-Agent": "test"}, timeout=5).status_code == 200
+
+    mock_sleep.assert_called_once_with(3.0)
+
+
+@patch("find_posts.time.sleep")
+@patch("find_posts.HTTP_SESSIONS")
+@patch("find_posts.can_fetch", return_value=True)
+def test_get_stops_retrying_when_budget_is_used_up(mock_can_fetch, mock_sessions, mock_sleep):
+    session = mock_sessions.get.return_value
+    session.get.return_value = make_response(504)
+
+    with patch("find_posts.RETRY_POLICY", find_posts.RetryPolicy(max_retries=5, budget=1)):
+        assert get("https://down.example/", {"User-Agent": "test"}, timeout=5).status_code == 504
+        assert get("https://down.example/", {"User-Agent": "test"}, timeout=5).status_code == 504
+
+    assert session.get.call_count == 3
+
+
+@patch("find_posts.HTTP_SESSIONS")
+@patch("find_posts.can_fetch", return_value=True)
+def test_rate_limited_work_is_deferred_while_other_hosts_continue(mock_can_fetch, mock_sessions):
+    order = []
+    limited = {"count": 0}
+
+    def respond(url, **kwargs):
+        if "limited.example" in url and limited["count"] == 0:
+            limited["count"] += 1
+            return make_response(429, {"Retry-After": "0.3"})
+        order.append(url)
+        return make_response(200)
+
+    mock_sessions.get.return_value.get.side_effect = respond
+
+    def fetch(url):
+        try:
+            return get(url, {"User-Agent": "test"}, timeout=5).status_code
+        except Exception:
+            return None
+
+    urls = ["https://limited.example/1", "https://other.example/1", "https://other.example/2"]
+    with patch("find_posts.DEFER_THRESHOLD", 0.1), patch("find_posts.RATE_LIMITER", find_posts.HostRateLimiter()):
+        results = find_posts.run_concurrently(fetch, urls, concurrency=1)
+
+    # the rate limited item was retried after the others, and still returns its own result
+    assert results == [200, 200, 200]
+    assert order == ["https://other.example/1", "https://other.example/2", "https://limited.example/1"]
+
+
+def test_wait_or_defer_sleeps_outside_of_work_items():
+    with patch("find_posts.time.sleep") as mock_sleep:
+        find_posts.wait_or_defer(30, "Rate limit hit")
+    mock_sleep.assert_called_once_with(30)
+
+
+def test_run_deferrable_defers_items_that_do_not_catch_the_deferral():
+    def fetch(item):
+        find_posts.wait_or_defer(30, "Rate limit hit")
+
+    with patch("find_posts.DEFER_THRESHOLD", 0.1):
+        result, deferred_until = find_posts.run_deferrable(fetch, "item")
+    assert result is None
+    assert deferred_until > time.time() + 20
+
+
+@patch("find_posts.get", side_effect=find_posts.RateLimitDeferred("Rate limit hit"))
+def test_add_context_url_passes_deferrals_on(mock_get):
+    with pytest.raises(find_posts.RateLimitDeferred):
+        find_posts.add_context_url("https://a.example/@user/1", "my.server", "token")
+
+
+@patch("find_posts.logger")
+@patch("find_posts.get", side_effect=find_posts.RateLimitDeferred("Rate limit hit"))
+def test_getting_context_passes_deferrals_on(mock_get, mock_logger):
+    with pytest.raises(find_posts.RateLimitDeferred):
+        find_posts.get_mastodon_urls("a.example", "1", "https://a.example/@user/1")
+    with pytest.raises(find_posts.RateLimitDeferred):
+        find_posts.get_user_posts_mastodon("user", "a.example")
+    mock_logger.error.assert_not_called()
+
+
+def test_single_worker_runs_inline():
+    def fetch(item):
+        if item == 0 and not deferred:
+            deferred.append(item)
+            find_posts.wait_or_defer(0.05, "Rate limit hit")
+        order.append(item)
+        return threading.current_thread()
+
+    for run in (lambda: find_posts.run_concurrently(fetch, range(3), concurrency=1),
+                lambda: find_posts.WorkerPool(1).map(fetch, range(3))):
+        order = []
+        deferred = []
+        with patch("find_posts.DEFER_THRESHOLD", 0.01), \
+                patch("find_posts.concurrent.futures.ThreadPoolExecutor", side_effect=AssertionError):
+            assert run() == [threading.current_thread()] * 3
+        assert order == [1, 2, 0]
+
+
+def test_dns_cache_reuses_lookups_until_ttl_expires():
+    cache = find_posts.DnsCache(ttl=60)
+    cache._getaddrinfo = Mock(return_value=[("addr",)])
+
+    assert cache.getaddrinfo("host.example", 443) == [("addr",)]
+    assert cache.getaddrinfo("host.example", 443) == [("addr",)]
+    assert cache._getaddrinfo.call_count == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    for key in cache._cache:
+        cache._cache[key] = (time.time() - 1, cache._cache[key][1])
+    cache.getaddrinfo("host.example", 443)
+    assert cache._getaddrinfo.call_count == 2
+
+
+def test_dns_cache_does_not_cache_failures():
+    cache = find_posts.DnsCache(ttl=60)
+    cache._getaddrinfo = Mock(side_effect=socket.gaierror)
+
+    for _ in range(2):
+        with pytest.raises(socket.gaierror):
+            cache.getaddrinfo("missing.example", 443)
+    assert cache._getaddrinfo.call_count == 2
+
+
+def test_dns_cache_prefetch_warms_the_cache():
+    cache = find_posts.DnsCache(ttl=60)
+    cache._getaddrinfo = Mock(return_value=[("addr",)])
+
+    cache.prefetch(["a.example", "b.example"]).join()
+    cache.getaddrinfo("a.example", 443, find_posts.allowed_gai_family(), socket.SOCK_STREAM)
+
+    assert cache._getaddrinfo.call_count == 2
+    assert cache.hits == 1
+
+
+@patch("find_posts.HTTP_SESSIONS")
+@patch("find_posts.can_fetch", return_value=True)
+def test_get_coalesces_identical_concurrent_requests(mock_can_fetch, mock_sessions):
+    def respond(url, **kwargs):
+        time.sleep(0.1)
+        return make_response(200, body='{"url": "%s"}' % url)
+
+    mock_sessions.get.return_value.get.side_effect = respond
+    urls = ["https://host.example/.well-known/nodeinfo"] * 4 + ["https://host.example/robots.txt"]
+
+    with patch("find_posts.IN_FLIGHT", find_posts.SingleFlight()) as in_flight:
+        results = find_posts.run_concurrently(
+            lambda url: get(url, {"User-Agent": "test"}, timeout=5).json()["url"], urls, concurrency=5
+        )
+
+    assert results == urls
+    assert mock_sessions.get.return_value.get.call_count == 2
+    assert in_flight.shared == 3
+
+
+def test_single_flight_shares_errors_and_forgets_finished_calls():
+    flight = find_posts.SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def fail():
+        started.set()
+        release.wait()
+        raise ValueError("boom")
+
+    errors = []
+
+    def follower():
+        started.wait()
+        try:
+            flight.do("key", lambda: "unused")
+        except ValueError as ex:
+            errors.append(ex)
+
+    def release_once_shared():
+        while flight.shared == 0:
+            time.sleep(0.01)
+        release.set()
+
+    threads = [threading.Thread(target=follower), threading.Thread(target=release_once_shared)]
+    for thread in threads:
+        thread.start()
+    with pytest.raises(ValueError):
+        flight.do("key", fail)
+    for thread in threads:
+        thread.join()
+
+    assert len(errors) == 1
+    assert flight.do("key", lambda: "fresh") == "fresh"
+
+
+def test_adaptive_timeouts_follow_observed_latency():
+    timeouts = find_posts.AdaptiveTimeouts(connect_timeout=3, minimum=2, maximum=30)
+    assert timeouts.timeout("new.example", 5) == (3, 5)
+
+    for latency in [0.1, 0.2, 0.1, 0.3, 0.2]:
+        timeouts.record("fast.example", latency)
+    assert timeouts.timeout("fast.example", 5) == (2, 2)
+
+    for latency in [4, 5, 6, 5, 8]:
+        timeouts.record("slow.example", latency)
+    assert timeouts.timeout("slow.example", 5) == (3, 24)
+
+    for latency in [20, 25, 30, 40, 50]:
+        timeouts.record("very-slow.example", latency)
+    assert timeouts.timeout("very-slow.example", 5) == (3, 30)
+
+
+def test_adaptive_timeouts_keep_recent_samples():
+    latency = {}
+    timeouts = find_posts.AdaptiveTimeouts(latency)
+    for i in range(30):
+        timeouts.record("host.example", i)
+    assert latency["host.example"] == list(range(10, 30))
+
+    seen_hosts = find_posts.ServerList({})
+    seen_hosts.latency = latency
+    assert find_posts.ServerList(json.loads(seen_hosts.toJSON())).latency == latency
+
+
+@patch("find_posts.HTTP_SESSIONS")
+@patch("find_posts.can_fetch", return_value=True)
+def test_read_timeouts_retry_with_more_time_then_fail_fast(mock_can_fetch, mock_sessions):
+    mock_sessions.get.return_value.get.side_effect = requests.exceptions.ReadTimeout
+
+    with patch("find_posts.HOST_TIMEOUTS", find_posts.AdaptiveTimeouts(minimum=2, maximum=30)) as timeouts, \
+            patch("find_posts.RETRY_POLICY", find_posts.RetryPolicy(max_retries=0)):
+        for _ in range(3):
+            with pytest.raises(requests.exceptions.ReadTimeout):
+                get("https://dead.example/", {"User-Agent": "test"}, timeout=5)
+
+    # timeouts aren't latency samples
+    assert timeouts.latency == {"dead.example": [None, None, None]}
+    assert [call.kwargs["timeout"][1] for call in mock_sessions.get.return_value.get.call_args_list] == [5, 30, 15]
+
+    for _ in range(5):
+        timeouts.record_timeout("dead.example")
+    assert timeouts.timeout("dead.example", 5) == (2, 2)
+
+    # a host slower than the default timeout gets samples, once it is given the time to respond
+    timeouts.record_timeout("slow.example")
+    assert timeouts.timeout("slow.example", 5) == (3, 30)
+    for latency in [12, 10, 11, 9, 10]:
+        timeouts.record("slow.example", latency)
+    assert timeouts.timeout("slow.example", 5) == (3, 30)
+
+
+def test_session_pool_falls_back_to_http1_without_httpx():
+    with patch("find_posts.httpx", None):
+        pool = find_posts.SessionPool(http2_hosts=["*"])
+        assert isinstance(pool.get("https://big.example/"), requests.Session)
+
+
+def test_http2_needs_h2():
+    # import find_posts afresh, as if httpx was installed without h2
+    script = "import sys; sys.modules['h2'] = None; import find_posts; print(find_posts.httpx)"
+    result = subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(os.path.abspath(find_posts.__file__)), capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "None"
+
+
+def test_session_pool_uses_http2_for_configured_hosts():
+    pytest.importorskip("httpx")
+    pytest.importorskip("h2")
+    pool = find_posts.SessionPool(http2_hosts=["big.example"])
+
+    assert isinstance(pool.get("https://big.example/"), find_posts.Http2Session)
+    assert isinstance(pool.get("https://small.example/"), requests.Session)
+
+
+def test_http2_session_behaves_like_requests():
+    httpx = pytest.importorskip("httpx")
+    pytest.importorskip("h2")
+
+    def handler(request):
+        if request.url.host == "timeout.example":
+            raise httpx.ConnectTimeout("timed out", request=request)
+        return httpx.Response(
+            200, json={"ok": True}, headers={"Link": '<https://big.example/next>; rel="next"', "X-RateLimit-Remaining": "5"}
+        )
+
+    session = find_posts.Http2Session()
+    session._client = httpx.Client(transport=httpx.MockTransport(handler))
+
+    response = session.get("https://big.example/api/v1/timelines/home", headers={"User-Agent": "test"}, timeout=(3, 5))
+    assert isinstance(response, requests.Response)
+    assert response.json() == {"ok": True}
+    assert response.headers["x-ratelimit-remaining"] == "5"
+    assert response.links["next"]["url"] == "https://big.example/next"
+
+    with pytest.raises(requests.exceptions.ConnectTimeout):
+        session.get("https://timeout.example/", timeout=(3, 5))
+    # the mock transport never opens a connection
+    assert session.connection_counts() == (0, 2)
+
+
+def test_http2_session_counts_the_connections_it_opens():
+    pytest.importorskip("httpx")
+    pytest.importorskip("h2")
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"ok")
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        session = find_posts.Http2Session()
+        for _ in range(3):
+            # without TLS there's no HTTP/2, so this keeps a single HTTP/1.1 connection alive
+            assert session.get(f"http://127.0.0.1:{server.server_port}/", timeout=(3, 5)).text == "ok"
+        assert session.connection_counts() == (1, 3)
+        session.close()
+    finally:
+        server.shutdown()
+
+
+def test_rate_limits_carry_over_to_the_next_run():
+    limiter = find_posts.HostRateLimiter()
+    reset = time.time() + 120
+    limiter.update(("big.example", "abc"), {"x-ratelimit-limit": "300", "x-ratelimit-remaining": "0", "x-ratelimit-reset": str(reset)})
+    limiter.update(("old.example", None), {"x-ratelimit-limit": "300", "x-ratelimit-remaining": "0", "x-ratelimit-reset": str(time.time() - 1)})
+    limiter.block(("retry-after.example", None), time.time() + 60)
+
+    next_run = find_posts.HostRateLimiter()
+    next_run.load(json.loads(limiter.toJSON()))
+
+    assert next_run.exhausted() == {"big.example", "retry-after.example"}
+    assert 119 < next_run.delay(("big.example", "abc")) <= 120
+    assert next_run.delay(("old.example", None)) == 0
+
+
+def test_rate_limited_host_is_deferred_instead_of_probed():
+    limiter = find_posts.HostRateLimiter()
+    limiter.load([{"host": "big.example", "token": None, "limit": 300, "remaining": 0, "reset": time.time() + 60}])
+
+    with patch("find_posts.RATE_LIMITER", limiter), \
+            patch("find_posts.HTTP_SESSIONS") as mock_sessions, \
+            patch("find_posts.can_fetch", return_value=True):
+        result, deferred_until = find_posts.run_deferrable(
+            lambda url: get(url, {"User-Agent": "test"}, timeout=5), "https://big.example/api/v1/statuses/1/context"
+        )
+
+    mock_sessions.get.return_value.get.assert_not_called()
+    assert deferred_until > time.time() + 55
+
+
+def test_run_concurrently_interleaves_hosts():
+    items = ["big/1", "big/2", "big/3", "small/1", "other/1", "small/2"]
+    started = []
+
+    def work(item):
+        started.append(item)
+        return item.upper()
+
+    results = find_posts.run_concurrently(work, items, concurrency=1, host_of=lambda item: item.split("/")[0])
+
+    assert started == ["big/1", "small/1", "other/1", "big/2", "small/2", "big/3"]
+    assert results == [item.upper() for item in items]
+
+
+def test_host_request_cap():
+    cap = find_posts.HostRequestCap(2, exempt=["my.server"])
+
+    assert cap.take("big.example")
+    assert cap.take("big.example")
+    assert not cap.take("big.example")
+    assert not cap.allows("big.example")
+    assert cap.allows("small.example")
+    for _ in range(5):
+        assert cap.take("my.server")
+    assert cap.capped == {"big.example"}
+
+
+@patch("find_posts.get_toot_context", return_value=["context"])
+@patch("find_posts.logger")
+def test_get_all_known_context_urls_respects_host_cap(mock_logger, mock_get_toot_context):
+    find_posts.recently_checked_context = {}
+    toots = [
+        {"url": f"https://{host}/@user/{i}", "uri": f"https://{host}/users/user/statuses/{i}", "reblog": None,
+         "visibility": "public", "created_at": "2024-01-01T00:00:00.000Z"}
+        for host, i in [("big.example", 1), ("big.example", 2), ("small.example", 3)]
+    ]
+    cap = find_posts.HostRequestCap(1)
+    cap.take("big.example")
+
+    with patch("find_posts.HOST_REQUESTS", cap):
+        find_posts.get_all_known_context_urls("my.server", toots, {}, {})
+
+    mock_get_toot_context.assert_called_once_with("small.example", "3", toots[2]["url"], {})
+    assert list(find_posts.recently_checked_context) == [toots[2]["uri"]]
+
+
+def test_token_pool_picks_token_with_most_budget():
+    limiter = find_posts.HostRateLimiter()
+    pool = find_posts.TokenPool(["a", "b", "c"])
+    reset = time.time() + 300
+
+    def key(token):
+        return find_posts.rate_limit_key("https://my.server/", {"Authorization": f"Bearer {token}"})
+
+    limiter.update(key("a"), {"x-ratelimit-remaining": "5", "x-ratelimit-limit": "300", "x-ratelimit-reset": str(reset)})
+    limiter.update(key("b"), {"x-ratelimit-remaining": "250", "x-ratelimit-limit": "300", "x-ratelimit-reset": str(reset)})
+    limiter.update(key("c"), {"x-ratelimit-remaining": "0", "x-ratelimit-limit": "300", "x-ratelimit-reset": str(reset)})
+
+    with patch("find_posts.RATE_LIMITER", limiter):
+        assert pool.pick("my.server", "a") == "b"
+        limiter.block(key("b"), reset + 60)
+        assert pool.pick("my.server", "a") == "a"
+        limiter.block(key("a"), reset + 60)
+        assert pool.pick("my.server", "a") == "c"
+
+
+def test_token_pool_rotates_unknown_tokens():
+    pool = find_posts.TokenPool(["a", "b"])
+
+    with patch("find_posts.RATE_LIMITER", find_posts.HostRateLimiter()):
+        assert [pool.pick("my.server", "a") for _ in range(4)] == ["a", "b", "a", "b"]
+    assert find_posts.TokenPool(["a"]).pick("my.server", "x") == "x"
+
+
+def test_adaptive_concurrency_aimd():
+    limit = find_posts.AdaptiveConcurrency(maximum=4, target_latency=1)
+    assert limit.limit == 1
+
+    def run(count, seconds, success=True):
+        for _ in range(count):
+            limit.acquire()
+            limit.release(seconds, success)
+
+    run(5, 0.1)
+    assert limit.limit == 2
+    run(10, 0.1)
+    assert limit.limit == 4
+    run(5, 0.1)
+    assert limit.limit == 4
+
+    run(5, 2)
+    assert limit.limit == 2
+    run(1, 0.1, success=False)
+    assert limit.limit == 1
+    run(1, 0.1, success=False)
+    assert limit.limit == 1
+
+
+def test_adaptive_concurrency_fixed_without_target():
+    limit = find_posts.AdaptiveConcurrency(maximum=3)
+    assert limit.limit == 3
+    for _ in range(3):
+        limit.acquire()
+    assert limit.active == 3
+    limit.release(10, success=False)
+    assert limit.limit == 3
+
+
+@patch("find_posts.get")
+def test_add_context_url_reports_to_resolve_limit(mock_get):
+    mock_get.return_value = make_response(503)
+    limit = find_posts.AdaptiveConcurrency(maximum=4, target_latency=1)
+    limit.limit = 4
+
+    with patch("find_posts.RESOLVE_LIMIT", limit):
+        assert find_posts.add_context_url("https://remote.example/@a/1", "my.server", "token") is False
+
+    assert limit.limit == 2
+    assert limit.active == 0
+
+
+@patch("find_posts.HTTP_SESSIONS")
+@patch("find_posts.can_fetch", return_value=True)
+def test_add_context_url_reports_network_time_and_retried_429s(mock_can_fetch, mock_sessions):
+    limit = find_posts.AdaptiveConcurrency(maximum=8, target_latency=0.1)
+    limit.limit = 4
+    limiter = Mock()
+    # pacing our own requests doesn't count as latency
+    limiter.wait.side_effect = lambda key: time.sleep(0.2)
+
+    mock_sessions.get.return_value.get.return_value = make_response(200)
+    with patch("find_posts.RESOLVE_LIMIT", limit), patch("find_posts.RATE_LIMITER", limiter), \
+            patch("find_posts.arguments", Mock(http_timeout=5), create=True):
+        for i in range(5):
+            assert find_posts.add_context_url(f"https://remote.example/@a/{i}", "my.server", "token")
+    assert limit.limit == 5
+
+    # a 429 that was retried successfully is still a sign of congestion
+    limit.limit = 4
+    mock_sessions.get.return_value.get.side_effect = [make_response(429, {"Retry-After": "0"}), make_response(200)]
+    with patch("find_posts.RESOLVE_LIMIT", limit), patch("find_posts.RATE_LIMITER", find_posts.HostRateLimiter()), \
+            patch("find_posts.arguments", Mock(http_timeout=5), create=True):
+        assert find_posts.add_context_url("https://remote.example/@a/6", "my.server", "token")
+    assert limit.limit == 2
+    assert limit.active == 0
+
+
+def test_can_fetch_caches_parsed_robots_txt():
+    find_posts.INSTANCE_BLOCKLIST = []
+    find_posts.ROBOT_RULES.clear()
+    robots_txt = "User-agent: *\nDisallow: /private/\nDisallow: /api/v1/accounts"
+
+    with patch("find_posts.get_robots_from_url", return_value=robots_txt), \
+            patch("find_posts.urllib.robotparser.RobotFileParser", wraps=find_posts.urllib.robotparser.RobotFileParser) as parser:
+        assert find_posts.can_fetch("agent", "https://cached.example/api/v1/statuses/1/context")
+        assert find_posts.can_fetch("agent", "https://cached.example/api/v1/statuses/2/context")
+        assert not find_posts.can_fetch("agent", "https://cached.example/private/thing")
+        assert not find_posts.can_fetch("agent", "https://cached.example/api/v1/accounts/1/statuses")
+        assert find_posts.can_fetch("agent", "https://cached.example/api/v1/account")
+        assert parser.call_count == 1
+
+    # a changed robots.txt is parsed again
+    with patch("find_posts.get_robots_from_url", return_value="User-agent: *\nDisallow: /"):
+        assert not find_posts.can_fetch("agent", "https://cached.example/api/v1/statuses/1/context")
+
+
+def test_robot_rules_match_robot_file_parser():
+    robots_txt = "User-agent: agent\nAllow: /a/b%20c\nDisallow: /a/\n\nUser-agent: *\nDisallow: /x?y=1\nDisallow: /caf%C3%A9"
+    rules = find_posts.RobotRules(robots_txt)
+    parser = find_posts.urllib.robotparser.RobotFileParser()
+    parser.parse(robots_txt.splitlines())
+
+    for agent in ["agent", "other"]:
+        for path in ["/a/b c/d", "/a/b%20c", "/a/bc", "/a/", "/x?y=1&z", "/x?y=2", "/café/1", "/caf", "/"]:
+            url = f"https://robots.example{path}"
+            assert rules.can_fetch(agent, url) == parser.can_fetch(agent, url)
+            assert rules.can_fetch(agent, url) == parser.can_fetch(agent, url)
+
+
+def test_robots_store_ttl():
+    store = find_posts.RobotsStore()
+    store.put("https://a.example/robots.txt", "User-agent: *")
+    store.put("https://b.example/robots.txt", "Disallow: /", {"Cache-Control": "public, max-age=60"})
+    store.put("https://c.example/robots.txt", "Disallow: /", {"Cache-Control": "max-age=99999999"})
+
+    assert store.entries["https://a.example/robots.txt"]["ttl"] == store.DEFAULT_TTL
+    assert store.entries["https://b.example/robots.txt"]["ttl"] == store.MIN_TTL
+    assert store.entries["https://c.example/robots.txt"]["ttl"] == store.MAX_TTL
+    assert store.get("https://a.example/robots.txt") == "User-agent: *"
+    assert store.get("https://unknown.example/robots.txt") is None
+
+    store.entries["https://a.example/robots.txt"]["fetched"] -= store.DEFAULT_TTL + 1
+    assert set(json.loads(store.toJSON())) == {"https://b.example/robots.txt", "https://c.example/robots.txt"}
+    assert store.get("https://a.example/robots.txt") is None
+    assert "https://a.example/robots.txt" not in store.entries
+
+
+def test_robots_store_load_keeps_newer_entries():
+    store = find_posts.RobotsStore()
+    store.put("https://a.example/robots.txt", "Disallow: /")
+
+    store.load({
+        "https://a.example/robots.txt": {"text": "User-agent: *", "fetched": time.time() - 60, "ttl": store.DEFAULT_TTL},
+        "https://b.example/robots.txt": {"text": "User-agent: *", "fetched": time.time() - 60, "ttl": store.DEFAULT_TTL},
+    })
+    assert store.get("https://a.example/robots.txt") == "Disallow: /"
+    assert store.get("https://b.example/robots.txt") == "User-agent: *"
+
+
+def test_journaled_robots_store_appends(tmp_path, monkeypatch):
+    path = tmp_path / "robots"
+    # as earlier versions wrote it
+    path.write_text(json.dumps({"https://a.example/robots.txt": {"text": "User-agent: *", "fetched": time.time(), "ttl": 3600}}))
+
+    store = find_posts.JournaledRobotsStore(str(path))
+    assert store.get("https://a.example/robots.txt") == "User-agent: *"
+    store.save()
+    assert len(path.read_text().splitlines()) == 1
+
+    store.put("https://b.example/robots.txt", "Disallow: /")
+    store.put("https://a.example/robots.txt", "Disallow: /private/")
+    store.save()
+    # only the stored entries are appended
+    assert len(path.read_text().splitlines()) == 3
+
+    restored = find_posts.JournaledRobotsStore(str(path))
+    assert restored.get("https://a.example/robots.txt") == "Disallow: /private/"
+    assert restored.get("https://b.example/robots.txt") == "Disallow: /"
+    assert find_posts.JournaledRobotsStore.read(str(path)) == restored.entries
+
+    # once most lines are outdated, the file is compacted
+    monkeypatch.setattr(find_posts.JournaledRobotsStore, "COMPACT_AT", 2)
+    restored.put("https://a.example/robots.txt", "Disallow: /")
+    restored.put("https://a.example/robots.txt", "Disallow: /")
+    restored.save()
+    assert len(path.read_text().splitlines()) == 2
+    assert find_posts.JournaledRobotsStore.read(str(path)) == restored.entries
+
+
+def test_robots_store_in_state_db(tmp_path):
+    db = find_posts.StateDb(tmp_path / "state.db")
+    store = find_posts.RobotsStore(find_posts.SqliteDict(db, "robots", max_age=find_posts.RobotsStore.MAX_TTL))
+    store.put("https://a.example/robots.txt", "Disallow: /")
+    db.close()
+
+    db = find_posts.StateDb(tmp_path / "state.db")
+    store = find_posts.RobotsStore(find_posts.SqliteDict(db, "robots", max_age=find_posts.RobotsStore.MAX_TTL))
+    assert store.get("https://a.example/robots.txt") == "Disallow: /"
+    assert store.get("https://b.example/robots.txt") is None
+    db.close()
+
+
+@patch("find_posts.get")
+def test_get_robots_from_url_stores_robots_txt(mock_get):
+    mock_get.return_value = make_response(200, {"Cache-Control": "max-age=7200"}, "User-agent: *\nDisallow: /")
+    find_posts.ROBOTS_TXT = {}
+
+    with patch("find_posts.ROBOTS_STORE", find_posts.RobotsStore()) as store:
+        assert find_posts.get_robots_from_url("https://store.example/robots.txt") == "User-agent: *\nDisallow: /"
+        assert store.entries["https://store.example/robots.txt"]["ttl"] == 7200
+
+        find_posts.ROBOTS_TXT = {}
+        assert find_posts.get_robots_from_url("https://store.example/robots.txt") == "User-agent: *\nDisallow: /"
+        assert mock_get.call_count == 1
+
+
+@patch("find_posts.get_server_info")
+def test_bootstrap_hosts(mock_get_server_info):
+    seen_hosts = find_posts.ServerList({"known.example": {"software": "mastodon"}})
+    hosts = ["new.example", "known.example", "my.server", "new.example", "other.example"]
+
+    with patch("find_posts.CONCURRENCY", 4):
+        find_posts.bootstrap_hosts("my.server", hosts, seen_hosts)
+
+    assert sorted(call.args[0] for call in mock_get_server_info.call_args_list) == ["new.example", "other.example"]
+
+    mock_get_server_info.reset_mock()
+    with patch("find_posts.CONCURRENCY", 1):
+        find_posts.bootstrap_hosts("my.server", hosts, seen_hosts)
+    mock_get_server_info.assert_not_called()
+
+
+@patch("find_posts.get_toot_context", return_value=[])
+@patch("find_posts.bootstrap_hosts")
+def test_get_all_known_context_urls_bootstraps_hosts(mock_bootstrap_hosts, mock_get_toot_context):
+    find_posts.recently_checked_context = {}
+    toots = [
+        {"url": f"https://{host}/@user/{i}", "uri": f"https://{host}/users/user/statuses/{i}", "reblog": None,
+         "visibility": "public", "created_at": "2024-01-01T00:00:00.000Z"}
+        for host, i in [("a.example", 1), ("b.example", 2), ("a.example", 3)]
+    ]
+    seen_hosts = find_posts.ServerList({})
+
+    find_posts.get_all_known_context_urls("my.server", toots, {}, seen_hosts)
+
+    mock_bootstrap_hosts.assert_called_once_with("my.server", ["a.example", "b.example", "a.example"], seen_hosts)
+
+
+def test_domain_blocklist():
+    blocklist = find_posts.DomainBlocklist(["exact.example", "*.wild.example", " Spaces.Example ", ""])
+    blocklist.add("suspended.example", subdomains=True)
+
+    assert "exact.example" in blocklist
+    assert "sub.exact.example" not in blocklist
+    assert "wild.example" not in blocklist
+    assert "a.b.wild.example" in blocklist
+    assert "spaces.example" in blocklist
+    assert "suspended.example" in blocklist
+    assert "Social.Suspended.Example:443" in blocklist
+    assert "notsuspended.example" not in blocklist
+    assert "example" not in blocklist
+    assert len(blocklist) == 4
+
+
+def test_can_fetch_blocks_subdomains():
+    blocklist = find_posts.DomainBlocklist(["*.blocked.example"])
+
+    with patch("find_posts.INSTANCE_BLOCKLIST", blocklist):
+        with pytest.raises(Exception, match="prohibited by the configured blocklist"):
+            find_posts.can_fetch("agent", "https://social.blocked.example/api/v1/instance")
+
+
+def test_read_domain_blocks_csv(tmp_path):
+    export = tmp_path / "blocks.csv"
+    export.write_text(
+        "#domain,#severity,#reject_media,#reject_reports,#public_comment,#obfuscate\n"
+        "suspended.example,suspend,false,false,,false\n"
+        "silenced.example,silence,false,false,,false\n"
+    )
+    plain = tmp_path / "plain.csv"
+    plain.write_text("one.example\n\ntwo.example\n")
+
+    assert find_posts.read_domain_blocks_csv(export) == ["suspended.example"]
+    assert find_posts.read_domain_blocks_csv(plain) == ["one.example", "two.example"]
+
+
+@patch("find_posts.get_paginated_mastodon")
+def test_get_server_domain_blocks_cached(mock_get_paginated_mastodon, tmp_path):
+    cache_file = tmp_path / "domain_blocks"
+    mock_get_paginated_mastodon.return_value = [
+        {"domain": "suspended.example", "severity": "suspend"},
+        {"domain": "silenced.example", "severity": "silence"},
+    ]
+
+    assert find_posts.get_server_domain_blocks("my.server", "token", cache_file, 24) == ["suspended.example"]
+    assert find_posts.get_server_domain_blocks("my.server", "token", cache_file, 24) == ["suspended.example"]
+    assert mock_get_paginated_mastodon.call_count == 1
+
+    # once the cache expired, we use it only if the server can't be reached
+    mock_get_paginated_mastodon.side_effect = Exception("403")
+    assert find_posts.get_server_domain_blocks("my.server", "token", cache_file, 0) == ["suspended.example"]
+    assert mock_get_paginated_mastodon.call_count == 2
+
+
+def test_sqlite_ordered_set(tmp_path):
+    db = find_posts.StateDb(tmp_path / "state.db")
+    assert db.created
+    urls = find_posts.SqliteOrderedSet(db, "seen_urls", keep=3)
+    users = find_posts.SqliteOrderedSet(db, "recently_checked_users", max_age=60 * 60)
+
+    urls.update(["a", "b"])
+    urls.add("c")
+    urls.add("a")
+    urls.update(["d", "e"])
+    assert list(urls) == ["a", "b", "c", "d", "e"]
+    assert "c" in urls and "x" not in urls
+    urls.pop("c")
+    assert len(urls) == 4
+
+    now = datetime.now().astimezone()
+    users.add("old@example", now - find_posts.timedelta(hours=2))
+    users.add("new@example", now)
+    assert "old@example" not in users
+    assert abs((users.get("new@example") - now).total_seconds()) < 1
+    with pytest.raises(KeyError):
+        users.get("old@example")
+    db.close()
+
+    db = find_posts.StateDb(tmp_path / "state.db")
+    assert not db.created
+    assert list(find_posts.SqliteOrderedSet(db, "seen_urls", keep=3)) == ["d", "e"]
+    assert list(find_posts.SqliteOrderedSet(db, "recently_checked_users")) == ["new@example"]
+    db.close()
+
+
+def test_sqlite_dict(tmp_path):
+    db = find_posts.StateDb(tmp_path / "state.db")
+    context = find_posts.SqliteDict(db, "recent_context", find_posts.decode_checked_context, find_posts.checked_context_expired)
+    ids = find_posts.SqliteDict(db, "replied_toot_server_ids")
+
+    ids["https://my.server/@a/1"] = None
+    ids["https://my.server/@a/2"] = ("https://remote.example/@a/2", ("remote.example", "2"))
+    assert "https://my.server/@a/1" in ids and ids["https://my.server/@a/1"] is None
+    assert ids["https://my.server/@a/2"] == ["https://remote.example/@a/2", ["remote.example", "2"]]
+    assert ids.pop("https://my.server/@a/1") is None
+    assert ids.pop("https://my.server/@a/1", "gone") == "gone"
+    with pytest.raises(KeyError):
+        ids["https://my.server/@a/1"]
+
+    now = datetime.now().astimezone()
+    context["recent"] = {"created_at": "2024-01-01T00:00:00.000Z", "lastSeen": now}
+    context["old"] = {"created_at": "2024-01-01T00:00:00.000Z", "lastSeen": now - find_posts.timedelta(days=8)}
+    assert isinstance(context["recent"]["lastSeen"], datetime)
+    assert isinstance(context["recent"]["created_at"], datetime)
+    assert dict(context.items()).keys() == {"recent"}
+    assert "old" not in context
+    assert len(context) == 1
+    db.close()
+
+
+def test_sqlite_server_list(tmp_path):
+    db = find_posts.StateDb(tmp_path / "state.db")
+    seen_hosts = find_posts.SqliteServerList(db, lambda serverInfo: find_posts.server_info_expired(serverInfo, 30))
+    now = datetime.now().astimezone()
+
+    seen_hosts.add("up.example", {"webserver": "up.example", "peertubeApiSupport": False, "last_checked": now})
+    seen_hosts.add("down.example", {"info": None, "last_checked": now - find_posts.timedelta(hours=2)})
+    seen_hosts.add("stale.example", {"webserver": "stale.example", "peertubeApiSupport": False, "last_checked": now - find_posts.timedelta(days=31)})
+    seen_hosts.health["down.example"] = {"state": "open", "failures": 5}
+
+    assert seen_hosts.get("up.example")["last_checked"] == now
+    assert "down.example" not in seen_hosts
+    assert "stale.example" not in seen_hosts
+    db.close()
+
+    db = find_posts.StateDb(tmp_path / "state.db")
+    seen_hosts = find_posts.SqliteServerList(db)
+    assert list(seen_hosts) == ["up.example"]
+    assert seen_hosts.health == {"down.example": {"state": "open", "failures": 5}}
+    db.close()
+
+
+@patch("find_posts.get_toot_context", return_value=["https://remote.example/@b/2"])
+def test_get_all_known_context_urls_with_sqlite_state(mock_get_toot_context, tmp_path):
+    db = find_posts.StateDb(tmp_path / "state.db")
+    find_posts.recently_checked_context = find_posts.SqliteDict(db, "recent_context", find_posts.decode_checked_context, find_posts.checked_context_expired)
+    toot = {"url": "https://remote.example/@a/1", "uri": "https://remote.example/users/a/statuses/1", "reblog": None,
+            "visibility": "public", "created_at": "2024-01-01T00:00:00.000Z"}
+
+    assert find_posts.get_all_known_context_urls("my.server", [toot], {}, find_posts.SqliteServerList(db)) == {"https://remote.example/@b/2"}
+    assert isinstance(find_posts.recently_checked_context[toot["uri"]]["lastSeen"], datetime)
+    assert not find_posts.toot_context_should_be_fetched(toot)
+    db.close()
+
+
+def test_journaled_ordered_set_appends(tmp_path):
+    path = tmp_path / "seen_urls"
+    path.write_text("https://a.example/1\nhttps://a.example/2")
+
+    seen_urls = find_posts.JournaledOrderedSet(path)
+    assert list(seen_urls) == ["https://a.example/1", "https://a.example/2"]
+    seen_urls.add("https://a.example/2")
+    seen_urls.update(["https://a.example/3", "https://a.example/4"])
+    seen_urls.save()
+
+    assert path.read_text() == "https://a.example/1\nhttps://a.example/2\nhttps://a.example/3\nhttps://a.example/4\n"
+    assert list(find_posts.JournaledOrderedSet(path)) == [f"https://a.example/{i}" for i in range(1, 5)]
+
+
+def test_journaled_ordered_set_compacts(tmp_path):
+    path = tmp_path / "known_followings"
+    known_followings = find_posts.JournaledOrderedSet(path, keep=3, compact_at=5)
+
+    known_followings.update(["a", "b", "c", "d", "e"])
+    known_followings.save()
+    assert path.read_text() == "a\nb\nc\nd\ne\n"
+
+    known_followings.add("f")
+    known_followings.save()
+    assert path.read_text() == "d\ne\nf\n"
+    assert known_followings.lines == 3
+
+    known_followings.add("g")
+    known_followings.save()
+    assert path.read_text() == "d\ne\nf\ng\n"
+
+
+def test_pending_work_round_trip():
+    pending = find_posts.PendingWork()
+    users = [{"acct": "a@remote.example", "url": "https://remote.example/@a"}, {"acct": "b@remote.example", "url": "https://remote.example/@b"}]
+
+    pending.add_urls("token", ["https://remote.example/@a/1", "https://remote.example/@a/2"])
+    pending.resolved("token", "https://remote.example/@a/1")
+    pending.add_users("token", users)
+    pending.add_users("token", [{"acct": "c@remote.example", "url": "https://remote.example/@c"}], followed=True)
+    pending.backfilled("token", "a@remote.example")
+    pending.add_urls("other", [])
+
+    saved = json.loads(pending.toJSON())
+    assert list(saved) == [find_posts.xxhash.xxh64(b"token").hexdigest()]
+    assert "token" not in pending.toJSON()
+
+    restored = find_posts.PendingWork()
+    saved["stale"] = {"resolve": ["https://remote.example/@c/1"], "backfill": [], "time": time.time() - 2 * restored.MAX_AGE}
+    restored.load(saved)
+    assert restored.take("token") == (["https://remote.example/@a/2"], [users[1]], [{"acct": "c@remote.example", "url": "https://remote.example/@c"}])
+    assert restored.take("token") == ([], [], [])
+    assert list(restored._work) == []
+
+
+@patch("find_posts.add_context_url")
+def test_add_context_urls_tracks_pending_work(mock_add_context_url):
+    mock_add_context_url.side_effect = lambda url, server, token: url.endswith("1")
+    seen_urls = find_posts.OrderedSet([])
+    pending = find_posts.PendingWork()
+    # the run winds down before the third toot
+    budget = Mock()
+    budget.allows.side_effect = [True, True, False]
+
+    with patch("find_posts.PENDING_WORK", pending), patch("find_posts.RUN_BUDGET", budget):
+        find_posts.add_context_urls("my.server", "token", [f"https://remote.example/@a/{i}" for i in (1, 2, 3)], seen_urls)
+
+    assert list(seen_urls) == ["https://remote.example/@a/1"]
+    assert pending.take("token") == (["https://remote.example/@a/3"], [], [])
+
+
+@patch("find_posts.bootstrap_hosts")
+@patch("find_posts.get_user_posts")
+def test_add_user_posts_tracks_followed_users_apart(mock_get_user_posts, mock_bootstrap_hosts):
+    pending = find_posts.PendingWork()
+    followed = [{"acct": "a@remote.example", "url": "https://remote.example/@a"}]
+    mentioned = [{"acct": "b@remote.example", "url": "https://remote.example/@b"}]
+    # the run winds down before any user is backfilled
+    budget = Mock()
+    budget.allows.return_value = False
+
+    with patch("find_posts.PENDING_WORK", pending), patch("find_posts.RUN_BUDGET", budget):
+        find_posts.add_user_posts("my.server", "token", followed, set(), set(), set(), {}, followed=True)
+        find_posts.add_user_posts("my.server", "token", mentioned, set(), set(), set(), {})
+
+    mock_get_user_posts.assert_not_called()
+    assert pending.take("token") == ([], mentioned, followed)
+
+
+def test_checkpoints_save_on_request():
+    saved = []
+    checkpoints = find_posts.Checkpoints(lambda: saved.append(time.time()), 0)
+    assert not checkpoints.save(timeout=1)
+
+    checkpoints.start()
+    assert checkpoints.save(timeout=5)
+    assert checkpoints.save(timeout=5)
+    checkpoints.stop()
+
+    assert len(saved) == 2
+    assert not checkpoints.save(timeout=1)
+
+
+def test_checkpoints_terminate_saves_then_exits_on_the_checkpoint_thread():
+    saved = []
+    exited = threading.Event()
+    exits = []
+    checkpoints = find_posts.Checkpoints(lambda: saved.append(threading.current_thread()), 0,
+                                         lambda signum: (exits.append((signum, len(saved))), exited.set()))
+    checkpoints.POLL_INTERVAL = 0.05
+    checkpoints.start()
+
+    # as a signal handler would, from the main thread
+    checkpoints.terminate(15)
+
+    assert exited.wait(5)
+    assert exits == [(15, 1)]
+    assert saved[0] is not threading.current_thread()
+
+
+def test_server_list_to_json_copies_health_and_latency_under_lock():
+    seen_hosts = find_posts.ServerList({})
+    breaker = find_posts.CircuitBreaker(seen_hosts.health, threshold=1, lock=seen_hosts.lock)
+    breaker.record("dead.example", False)
+
+    with seen_hosts.lock:
+        # a worker thread holding the lock holds up serializing
+        done = []
+        thread = threading.Thread(target=lambda: done.append(seen_hosts.toJSON()))
+        thread.start()
+        thread.join(0.2)
+        assert not done
+    thread.join(5)
+
+    assert json.loads(done[0])[find_posts.ServerList.HEALTH_KEY]["dead.example"]["failures"] == 1
+    health, latency = seen_hosts.health_and_latency()
+    breaker.record("dead.example", False)
+    assert health["dead.example"]["failures"] == 1
+
+
+def test_toot_context_recorded_but_not_fetched_is_fetched():
+    toot = {"url": "https://remote.example/@a/1", "uri": "https://remote.example/users/a/statuses/1", "reblog": None,
+            "visibility": "public", "created_at": "2024-01-01T00:00:00.000Z"}
+    # as a checkpoint could have saved it before its context was fetched
+    find_posts.recently_checked_context = {toot["uri"]: dict(toot)}
+
+    assert find_posts.toot_context_should_be_fetched(toot)
+
+
+def test_bloom_filter():
+    bloom_filter = find_posts.BloomFilter(1000, 0.01)
+    added = [f"https://remote.example/@a/{i}" for i in range(1000)]
+    for url in added:
+        bloom_filter.add(url)
+    bloom_filter.add(added[0])
+
+    # items mistaken for ones already added are not counted
+    assert 980 <= bloom_filter.count <= 1000
+    assert all(url in bloom_filter for url in added)
+    false_positives = sum(f"https://remote.example/@b/{i}" in bloom_filter for i in range(10000))
+    assert false_positives < 300
+
+
+def test_filtered_set_remembers_beyond_items(tmp_path):
+    path = tmp_path / "seen_urls_filter"
+    items = find_posts.OrderedSet(["https://remote.example/@a/0"])
+    seen_urls = find_posts.FilteredSet(items, capacity=100, path=path)
+    assert "https://remote.example/@a/0" in seen_urls
+
+    seen_urls.update(f"https://remote.example/@a/{i}" for i in range(1, 150))
+    items.pop("https://remote.example/@a/1")
+    assert "https://remote.example/@a/1" in seen_urls
+    assert "https://remote.example/@b/1" not in seen_urls
+    assert len(seen_urls) == 149
+    seen_urls.save_filters()
+
+    restored = find_posts.FilteredSet(find_posts.OrderedSet([]), capacity=100, path=path)
+    assert all(f"https://remote.example/@a/{i}" in restored for i in range(150))
+
+    # the filters only keep the last two generations
+    restored.update(f"https://remote.example/@c/{i}" for i in range(200))
+    assert sum(f"https://remote.example/@a/{i}" in restored for i in range(100)) < 5
+
+    # filters of a different size are rebuilt from the items
+    rebuilt = find_posts.FilteredSet(find_posts.OrderedSet(["https://remote.example/@d/1"]), capacity=50, path=path)
+    assert "https://remote.example/@d/1" in rebuilt
+    assert "https://remote.example/@a/149" not in rebuilt
+
+
+def test_filtered_set_checks_items_behind_stale_filters(tmp_path):
+    path = tmp_path / "seen_urls_filter"
+    items = find_posts.OrderedSet(["https://remote.example/@a/0"])
+    find_posts.FilteredSet(items, capacity=100, path=path).save_filters()
+
+    # the run was killed after journaling this, but before saving the filters again
+    items.add("https://remote.example/@a/1")
+    restored = find_posts.FilteredSet(items, capacity=100, path=path)
+    assert "https://remote.example/@a/1" in restored
+
+    # the filters rotate out items the set still holds
+    restored.update(f"https://remote.example/@b/{i}" for i in range(250))
+    assert "https://remote.example/@a/1" in restored
+
+
+def test_filtered_set_rotates_filters_while_rebuilding():
+    items = find_posts.OrderedSet([f"https://remote.example/@a/{i}" for i in range(250)])
+    seen_urls = find_posts.FilteredSet(items, capacity=100)
+
+    assert seen_urls.current.count <= 100
+    assert seen_urls.previous.count <= 100